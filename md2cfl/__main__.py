@@ -20,15 +20,27 @@ import logging
 import argparse
 import getpass
 
-import keyring
-
-from md2cfl import confluence_api, report_parser, processor, prefs
+# Only lightweight modules are imported at load time, every command imports
+# the stack it requires (see README, Startup time)
+from md2cfl import prefs
 
 AMDX_LOG_FORMAT = '[%(asctime)s] {%(name)s:%(lineno)d} %(levelname)s: %(message)s'
 
 logger = logging.getLogger(__name__)
 
 
+def shard_spec(value):
+    try:
+        index, count = [int(item) for item in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid shard {value}, expected K/N')
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'Invalid shard {value}, K must be between 1 and N')
+
+    return index, count
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title='commands', dest='command')
@@ -36,9 +48,13 @@ def parse_args():
 
     run_subparser = subparsers.add_parser('run', help='Run the import to confluence')
 
-    run_subparser.add_argument('report',
+    run_subparser.add_argument('report', nargs='*',
                                help='XML generated by MD via the provided '
-                                    'exporter report template')
+                                    'exporter report template. Multiple reports '
+                                    'are imported together')
+    run_subparser.add_argument('--manifest', default=None,
+                               help='Text file listing the reports to import, one '
+                                    'per line')
     run_subparser.add_argument('--user', '-u',
                                default=None,
                                help='Confluence user for publishing')
@@ -48,6 +64,9 @@ def parse_args():
     run_subparser.add_argument('--url',
                                default='https://confluence.archimedes-exhibitions.de/',
                                help='Confluence base url')
+    run_subparser.add_argument('--output-dir', default=None, metavar='DIR',
+                               help='Write the pages to a local directory instead of '
+                                    'publishing them to Confluence')
     run_subparser.add_argument('--skip-restrictions', action='store_true',
                                help='Do not apply read-only page restrictions '
                                     'to the root page/s')
@@ -57,6 +76,44 @@ def parse_args():
     run_subparser.add_argument('--delete-children', action='store_true',
                                help='Delete all children of the top-level pages '
                                     'before populating them')
+    run_subparser.add_argument('--prune', action='store_true',
+                               help='Delete the pages whose package no longer '
+                                    'exists in the report')
+    run_subparser.add_argument('--jobs', '-j', type=int, default=None,
+                               help='Number of concurrent requests to confluence '
+                                    '(default: 4)')
+    run_subparser.add_argument('--shard', type=shard_spec, default=None, metavar='K/N',
+                               help='Process only the K-th of N deterministic partitions '
+                                    'of the root pages')
+    run_subparser.add_argument('--lease-ttl', type=int, default=3600,
+                               help='Seconds after which the lease of a sharded root '
+                                    'page expires (default: 3600)')
+    run_subparser.add_argument('--resume', action='store_true',
+                               help='Resume an interrupted run of the same reports')
+    run_subparser.add_argument('--pipeline', action='store_true',
+                               help='Stream the reports and overlap parsing, rendering '
+                                    'and network requests')
+    run_subparser.add_argument('--async', dest='use_async', action='store_true',
+                               help='Issue the requests from an asyncio event loop, --jobs '
+                                    'bounds the requests in flight (default: 32). Requires '
+                                    'aiohttp')
+    run_subparser.add_argument('--optimize-images', action='store_true',
+                               help='Losslessly recompress the diagrams before '
+                                    'uploading them')
+    run_subparser.add_argument('--max-image-size', type=int, default=None,
+                               help='Downscale optimized diagrams whose width or '
+                                    'height exceeds the given amount of pixels')
+    run_subparser.add_argument('--keep-image-metadata', action='store_true',
+                               help='Do not strip metadata from optimized diagrams')
+    run_subparser.add_argument('--dedupe-images', action='store_true',
+                               help='Upload identical diagrams only once and reference '
+                                    'them from the other pages')
+    run_subparser.add_argument('--no-report-cache', action='store_true',
+                               help='Always parse the reports, bypassing the cache of '
+                                    'parsed reports')
+    run_subparser.add_argument('--trace', default=None, metavar='FILE',
+                               help='Save a timeline of the run in Chrome trace-event '
+                                    'format')
     run_subparser.add_argument('--verbose', '-v', action='count', default=0,
                                help='Increase verbosity')
     run_subparser.add_argument('--quiet', '-q', action='store_true',
@@ -79,16 +136,78 @@ def parse_args():
                                                help='Validate report against schema')
     validate_subparser.add_argument('report',
                                     help='Report XML')
+    validate_subparser.add_argument('--no-report-cache', action='store_true',
+                                    help='Always parse the report, bypassing the cache of '
+                                         'parsed reports')
     validate_subparser.set_defaults(func=validate)
 
     return parser.parse_args()
 
 
+def read_manifest(manifest):
+    """Returns the reports listed in a manifest, relative paths are relative to the manifest"""
+    base_path = os.path.dirname(os.path.abspath(manifest))
+    reports = []
+
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                reports.append(os.path.join(base_path, line))
+
+    return reports
+
+
+def open_report_cache(args):
+    from md2cfl import report_cache
+
+    return None if args.no_report_cache else report_cache.ReportCache()
+
+
+def load_report(report_file, cache):
+    """Returns (version info, report) from the cache if possible, (None, None) if invalid"""
+    from md2cfl import report_parser
+
+    cached = cache.load(report_file) if cache else None
+    if cached:
+        return cached
+
+    version_info, report = report_parser.parse(report_file)
+
+    if report is not None and cache:
+        cache.store(report_file, version_info, report)
+
+    return version_info, report
+
+
+def stream_reports(report_files, cache):
+    from md2cfl import report_parser
+
+    for report_file in report_files:
+        cached = cache.load(report_file) if cache else None
+
+        if cached:
+            version_info, report = cached
+            for cfl_pageid, rootpage in report.items():
+                yield report_file, version_info, cfl_pageid, rootpage
+            continue
+
+        report = {}
+        for version_info, cfl_pageid, rootpage in report_parser.iterparse(report_file):
+            report[cfl_pageid] = rootpage
+            yield report_file, version_info, cfl_pageid, rootpage
+
+        if report and cache:
+            cache.store(report_file, version_info, report)
+
+
 def init_logger(level):
     logging.basicConfig(level=level, format=AMDX_LOG_FORMAT)
 
 
 def retrieve_credentials(args):
+    import keyring
+
     preferences = prefs.Prefs()
 
     if args.user:
@@ -117,6 +236,8 @@ def retrieve_credentials(args):
 
 
 def run(args):
+    from md2cfl import report_parser, processor, img_optimizer, tracing, journal
+
     if args.verbose >= 2:
         level = logging.DEBUG
     elif args.verbose == 1:
@@ -126,28 +247,110 @@ def run(args):
 
     init_logger(level)
 
-    user, password = retrieve_credentials(args)
+    if args.use_async and (args.pipeline or args.output_dir):
+        logger.error('--async can be combined neither with --pipeline nor with --output-dir')
+        sys.exit(2)
+
+    if args.use_async:
+        try:
+            from md2cfl import async_confluence_api, async_processor
+        except ImportError as e:
+            logger.error(f'--async requires aiohttp, install the async extra: {e}')
+            sys.exit(2)
+
+        jobs = args.jobs or async_confluence_api.DEFAULT_MAX_IN_FLIGHT
+        processor_class = async_processor.AsyncProcessor
+    else:
+        jobs = args.jobs or processor.DEFAULT_JOBS
+        processor_class = processor.Processor
+
+    tracer = tracing.Tracer(enabled=bool(args.trace))
+
+    if args.output_dir:
+        from md2cfl import fs_backend
+
+        cfl = fs_backend.FilesystemBackend(args.output_dir)
+    elif args.use_async:
+        user, password = retrieve_credentials(args)
+        cfl = async_confluence_api.AsyncConfluenceAPI(user=user,
+                                                      password=password,
+                                                      base_url=args.url,
+                                                      max_in_flight=jobs,
+                                                      tracer=tracer)
+    else:
+        from md2cfl import confluence_api
+
+        user, password = retrieve_credentials(args)
+        cfl = confluence_api.ConfluenceAPI(user=user,
+                                           password=password,
+                                           base_url=args.url,
+                                           pool_size=max(jobs, confluence_api.DEFAULT_POOL_SIZE),
+                                           tracer=tracer)
 
-    cfl = confluence_api.ConfluenceAPI(user=user,
-                                       password=password,
-                                       base_url=args.url)
+    report_files = list(args.report)
+    if args.manifest:
+        report_files += read_manifest(args.manifest)
 
-    version_info, report = report_parser.parse(args.report)
+    if not report_files:
+        logger.error('No report has been specified')
+        sys.exit(2)
+
+    cache = open_report_cache(args)
+
+    if args.pipeline:
+        reports = stream_reports(report_files, cache)
+    else:
+        reports = []
+        for report_file in report_files:
+            with tracer.span('parse', report=report_file):
+                version_info, report = load_report(report_file, cache)
+
+            if report is None:
+                sys.exit(1)
+
+            reports += [(report_file, version_info, cfl_pageid, rootpage)
+                        for cfl_pageid, rootpage in report.items()]
 
-    if report is None:
+    if args.optimize_images:
+        optimizer = img_optimizer.ImageOptimizer(max_size=args.max_image_size,
+                                                 strip_metadata=not args.keep_image_metadata)
+    else:
+        optimizer = None
+
+    target = os.path.abspath(args.output_dir) if args.output_dir else args.url.rstrip('/')
+    run_journal = journal.Journal.for_reports(report_files, target, args.shard)
+    run_journal.open(resume=args.resume)
+
+    p = processor_class(cfl=cfl,
+                        reports=reports,
+                        skip_restrictions=args.skip_restrictions,
+                        force_updates=args.force_updates,
+                        delete_children=args.delete_children,
+                        print_summary=not args.quiet and args.verbose == 0,
+                        img_optimizer=optimizer,
+                        prune=args.prune,
+                        jobs=jobs,
+                        tracer=tracer,
+                        shard=args.shard,
+                        lease_ttl=args.lease_ttl,
+                        pipelined=args.pipeline,
+                        journal=run_journal,
+                        dedupe_images=args.dedupe_images)
+    completed = False
+    try:
+        completed = p.process()
+    except report_parser.ReportError:
         sys.exit(1)
+    finally:
+        run_journal.close(completed)
 
-    p = processor.Processor(cfl=cfl,
-                            version_info=version_info,
-                            report=report,
-                            skip_restrictions=args.skip_restrictions,
-                            force_updates=args.force_updates,
-                            delete_children=args.delete_children,
-                            print_summary=not args.quiet and args.verbose == 0)
-    p.process()
+        if args.trace:
+            tracer.save(args.trace)
 
 
 def login(args):
+    import keyring
+
     init_logger(logging.INFO)
     preferences = prefs.Prefs()
 
@@ -177,6 +380,8 @@ def login(args):
 
 
 def logout(args):
+    import keyring
+
     init_logger(logging.INFO)
     preferences = prefs.Prefs()
 
@@ -198,10 +403,8 @@ def logout(args):
 
 
 def validate(args):
-    from . import report_parser
-
     init_logger(level=logging.INFO)
-    version_info, report = report_parser.parse(args.report)
+    version_info, report = load_report(args.report, open_report_cache(args))
 
     if version_info:
         logger.info(f'Validation successful. Version info: {version_info}')
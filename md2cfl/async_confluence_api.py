@@ -0,0 +1,303 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import asyncio
+import logging
+
+import aiohttp
+
+from md2cfl import tracing
+from md2cfl.backend import APIError
+from md2cfl.confluence_api import (LIMIT_ENTRIES, UPLOAD_CHUNK_SIZE, MAX_UPLOAD_REQUEST_SIZE,
+                                   create_page_payload, update_page_payload, move_page_payload,
+                                   property_payload, labels_payload, restrictions_payload,
+                                   parse_attachments, upload_stream, batch_files)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT = 32
+
+
+class AsyncConfluenceAPI:
+    """asyncio counterpart of ConfluenceAPI, its operations are coroutines
+
+    All the requests share a connection pool, at most max_in_flight of them are
+    issued at any time. The client must be used as an async context manager, from
+    within the event loop running the requests.
+    """
+    def __init__(self, user, password, base_url, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 tracer=None):
+        self._user = user
+        self._password = password
+        self._base_url = base_url if base_url[-1] == '/' else base_url + '/'
+        self._max_in_flight = max_in_flight
+        self._tracer = tracer or tracing.NULL_TRACER
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        self._session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(self._user, self._password),
+            connector=aiohttp.TCPConnector(limit=self._max_in_flight))
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def create_page(self, parent_id, title, body, space_key=None, properties=None,
+                          labels=None):
+        if space_key is None:
+            space_key = await self.get_space_key(parent_id)
+
+        logger.debug(f'Creating new page under space={space_key}')
+
+        r = await self._perform_json_request('POST',
+                                             path='/content',
+                                             data=create_page_payload(parent_id, title, body,
+                                                                      space_key, properties,
+                                                                      labels))
+
+        logger.debug(f'Created new page result={r}')
+
+        return r
+
+    async def get_space_key(self, page_id):
+        return (await self.get_page_info(page_id))['space']['key']
+
+    async def get_page_by_name(self, space_key, name):
+        _, reply = await self._perform_request('GET',
+                                               path='/content',
+                                               params={'title': name, 'spaceKey': space_key})
+
+        return reply
+
+    async def get_property(self, page_id, key):
+        status, reply = await self._perform_request('GET',
+                                                    path=f'/content/{page_id}/property/{key}',
+                                                    raise_exception=False)
+
+        return None if status == 404 else reply
+
+    async def set_property(self, page_id, key, value):
+        prop = await self.get_property(page_id, key)
+
+        return await self._perform_json_request('POST' if prop is None else 'PUT',
+                                                path=f'/content/{page_id}/property/{key}',
+                                                data=property_payload(key, value, prop))
+
+    async def replace_property(self, page_id, key, value, prop):
+        status, reply = await self._perform_request('POST' if prop is None else 'PUT',
+                                                    path=f'/content/{page_id}/property/{key}',
+                                                    headers={'Accept': 'application/json',
+                                                             'Content-Type': 'application/json'},
+                                                    data=json.dumps(property_payload(key, value,
+                                                                                     prop)),
+                                                    raise_exception=False)
+
+        if status == 409:
+            return False
+        elif status != 200:
+            raise APIError(f'Error code={status} page_id={page_id} property={key} reply={reply}')
+
+        return True
+
+    async def delete_property(self, page_id, key):
+        status, _ = await self._perform_request('DELETE',
+                                                path=f'/content/{page_id}/property/{key}',
+                                                raise_exception=False)
+
+        return status in (200, 204)
+
+    async def delete_page(self, page_id):
+        status, _ = await self._perform_request('DELETE',
+                                                path=f'/content/{page_id}',
+                                                raise_exception=False)
+
+        return status in (200, 204)
+
+    async def get_children(self, page_id, expand=None):
+        params = {'limit': LIMIT_ENTRIES}
+        if expand:
+            params['expand'] = expand
+
+        _, reply = await self._perform_request('GET',
+                                               path=f'/content/{page_id}/child/page',
+                                               params=params)
+
+        return reply
+
+    async def get_attachments(self, page_id):
+        _, reply = await self._perform_request('GET',
+                                               path=f'/content/{page_id}/child/attachment',
+                                               params={'limit': LIMIT_ENTRIES,
+                                                       'expand': 'version,metadata'})
+
+        return parse_attachments(reply['results'])
+
+    async def upload_attachments(self, page_id, files, attachments=None,
+                                 max_request_size=MAX_UPLOAD_REQUEST_SIZE):
+        """See ConfluenceAPI.upload_attachments()"""
+        if attachments is None:
+            attachments = await self.get_attachments(page_id)
+
+        results = {}
+        new_files = []
+
+        for filepath, filename, comment in files:
+            if filename in attachments:
+                urlpath = f'/content/{page_id}/child/attachment/{attachments[filename]["id"]}/data'
+                try:
+                    await self._post_files(urlpath, [(filepath, filename, comment)])
+                except APIError as e:
+                    logger.warning(f'Cannot upload file={filename} to page_id={page_id}: {e}')
+                    results[filename] = False
+                else:
+                    results[filename] = True
+            else:
+                new_files.append((filepath, filename, comment))
+
+        for batch in batch_files(new_files, max_request_size):
+            try:
+                reply = await self._post_files(f'/content/{page_id}/child/attachment', batch)
+            except APIError as e:
+                logger.warning(f'Cannot upload files={[item[1] for item in batch]} '
+                               f'to page_id={page_id}: {e}')
+                uploaded = set()
+            else:
+                uploaded = {result['title'] for result in reply['results']}
+
+            for _, filename, _ in batch:
+                results[filename] = filename in uploaded
+
+        return results
+
+    async def get_page_info(self, page_id):
+        _, reply = await self._perform_request('GET', path=f'/content/{page_id}')
+
+        return reply
+
+    async def get_page_body(self, page_id):
+        _, reply = await self._perform_request('GET',
+                                               path=f'/content/{page_id}',
+                                               params={'expand': 'body.storage'})
+
+        return reply['body']['storage']['value']
+
+    async def update_page(self, page_id, title, body):
+        page_info = await self.get_page_info(page_id)
+
+        logger.debug(f'Updating page id={page_id} title={title} '
+                     f'new version={page_info["version"]["number"] + 1}')
+
+        return await self._perform_json_request('PUT',
+                                                path=f'/content/{page_id}',
+                                                data=update_page_payload(page_id, title, body,
+                                                                         page_info))
+
+    async def move_page(self, page_id, parent_id):
+        page_info = await self.get_page_info(page_id)
+
+        logger.debug(f'Moving page id={page_id} under parent id={parent_id}')
+
+        return await self._perform_json_request('PUT',
+                                                path=f'/content/{page_id}',
+                                                data=move_page_payload(page_id, parent_id,
+                                                                       page_info))
+
+    async def set_labels(self, page_id, labels):
+        reply = await self._perform_json_request('POST',
+                                                 path=f'/content/{page_id}/label',
+                                                 data=labels_payload(labels))
+
+        logger.debug(f'Added labels {labels} to page id={page_id} (reply={reply})')
+
+        return reply
+
+    async def set_page_restrictions(self, page_id):
+        return await self._perform_json_request('PUT',
+                                                path=f'/content/{page_id}/restriction',
+                                                data=restrictions_payload(self._user),
+                                                experimental_api=True)
+
+    async def _post_files(self, urlpath, files):
+        with upload_stream(files) as stream:
+            started = time.monotonic()
+            _, reply = await self._perform_request('POST',
+                                                   path=urlpath,
+                                                   headers={'X-Atlassian-Token': 'no-check',
+                                                            'Content-Type': stream.content_type,
+                                                            'Content-Length': str(len(stream))},
+                                                   data=self._read_chunks(stream))
+            elapsed = time.monotonic() - started
+
+        logger.info(f'Uploaded files={len(files)} size={len(stream)} time={elapsed:.2f}s '
+                    f'throughput={len(stream) / max(elapsed, 1e-6) / 1024:.1f}KiB/s')
+
+        return reply
+
+    async def _read_chunks(self, stream):
+        # Files are read in the default executor, not to block the event loop
+        loop = asyncio.get_running_loop()
+
+        while True:
+            chunk = await loop.run_in_executor(None, stream.read, UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            yield chunk
+
+    async def _perform_request(self, method, path, headers=None, data=None, raise_exception=True,
+                               experimental_api=False, **kwargs):
+        """Returns the status code and the decoded JSON reply, None if it has no JSON body"""
+        if experimental_api:
+            url = self._base_url + 'rest/experimental' + path
+        else:
+            url = self._base_url + 'rest/api' + path
+
+        async with self._semaphore:
+            with self._tracer.span(f'{method} {path}', category='http') as span_args:
+                async with self._session.request(method, url, headers=headers, data=data,
+                                                 **kwargs) as r:
+                    span_args['status'] = r.status
+                    text = await r.text()
+
+        if r.status != 200 and raise_exception:
+            raise APIError(f'Error code={r.status} url={url} text={text}')
+
+        try:
+            reply = json.loads(text) if text else None
+        except ValueError:
+            reply = None
+
+        return r.status, reply
+
+    async def _perform_json_request(self, method, path, data=None, raise_exception=True,
+                                    experimental_api=False):
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+        _, reply = await self._perform_request(method, path, headers=headers, data=json.dumps(data),
+                                               raise_exception=raise_exception,
+                                               experimental_api=experimental_api)
+
+        return reply
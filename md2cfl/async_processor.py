@@ -0,0 +1,254 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from progress.bar import IncrementalBar
+
+from md2cfl.backend import APIError
+from md2cfl.processor import Processor, LEASE_PROPERTY, CHILDREN_EXPAND
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncProcessor(Processor):
+    """Processor driving an AsyncConfluenceAPI from a single event loop
+
+    All the pages are rendered and their remote state fetched, then they are written
+    concurrently, the most expensive first. The number of requests in flight is bounded
+    by the client only, no thread is used per request. The pipelined mode is not
+    supported.
+
+    Only the steps issuing requests are overridden, as coroutines awaiting the client,
+    the decisions and the bookkeeping are left to the Processor helpers.
+    """
+    def process(self):
+        """Returns True if all the pages have been published without errors"""
+        asyncio.run(self._process())
+
+        self._print_report_summary()
+
+        return not self._errors
+
+    async def _process(self):
+        # Created within the event loop, Python < 3.10 binds the lock to the current loop
+        self._lease_lock = asyncio.Lock()
+
+        async with self._cfl:
+            for report_file, version_info, cfl_pageid, rootpage in self._reports:
+                self._add_root_page(report_file, version_info, cfl_pageid, rootpage)
+
+            self._owned = [cfl_pageid for cfl_pageid in self._report if self._in_shard(cfl_pageid)]
+
+            if self._shard:
+                self._owned = await self._leased(self._owned)
+                logger.info(f'Shard {self._shard[0]}/{self._shard[1]} owns {len(self._owned)} '
+                            f'of {len(self._report)} root pages')
+
+            try:
+                await self._process_owned()
+            finally:
+                await self._release_leases()
+
+    async def _process_owned(self):
+        if self._print_summary:
+            print(f'Starting MDImporter asynchronous processing on {len(self._owned)} root pages')
+
+        if self._img_optimizer:
+            with self._tracer.span('optimize images'):
+                self._upload_paths = self._img_optimizer.optimize(
+                    self._all_images(self._report[cfl_pageid] for cfl_pageid in self._owned))
+
+        with self._tracer.span('index remote pages'):
+            await self._index_remote_pages()
+
+        # Rendering references the space of the root pages, see _resolve_attachment_refs()
+        space_keys = await asyncio.gather(*[self._cfl.get_space_key(cfl_pageid)
+                                            for cfl_pageid in self._owned])
+        self._space_keys.update(zip(self._owned, space_keys))
+
+        jobs = []
+        for cfl_pageid in self._owned:
+            rootpage = self._report[cfl_pageid]
+
+            with self._tracer.span('rootpage', pageid=cfl_pageid,
+                                   qualname=rootpage.pagedata.qualifiedName):
+                for job in self._page_jobs(cfl_pageid):
+                    with self._page_span(job):
+                        if not job.is_root:
+                            self._resolve(job)
+
+                        self._render(job)
+
+                    if not self._is_completed(job):
+                        jobs.append(job)
+
+        with self._tracer.span('fetch pages', count=len(jobs)):
+            await asyncio.gather(*[self._fetch_page(job) for job in jobs])
+
+        if self._show_bars:
+            bar = IncrementalBar(f'Publishing pages ({len(jobs)})',
+                                 max=len(jobs),
+                                 suffix='%(percent)d%%')
+
+        # Tasks start in creation order and requests are granted in order, the most
+        # expensive pages get started first
+        jobs.sort(key=self._estimate_cost, reverse=True)
+        tasks = [asyncio.create_task(self._write_page(job)) for job in jobs]
+
+        for future in asyncio.as_completed(tasks):
+            await future
+
+            if self._show_bars:
+                bar.next()
+
+        if self._show_bars:
+            bar.finish()
+
+    async def _fetch_page(self, job):
+        with self._page_span(job):
+            await self._fetch(job)
+
+    async def _write_page(self, job):
+        with self._page_span(job):
+            await self._write(job)
+
+    async def _fetch(self, job):
+        if job.cfl_id is not None:
+            body, job.attachments = await asyncio.gather(self._cfl.get_page_body(job.cfl_id),
+                                                         self._cfl.get_attachments(job.cfl_id))
+            job.up_to_date = self._is_up_to_date(job, body)
+
+        job.attachments_todo = self._attachments_todo(job)
+
+    async def _write(self, job):
+        if not await self._holds_lease(job.cfl_root_pageid):
+            self._lease_lost(job)
+            return
+
+        ops = self._write_ops(job)
+
+        for op in ops:
+            method, args, kwargs = self._write_request(op, job)
+            try:
+                response = await method(*args, **kwargs)
+            except APIError as e:
+                self._write_failed(op, job, e)
+                return
+
+            self._written(op, job, response)
+
+        uploaded = await self._upload_attachments(job)
+
+        if 'create' not in ops:
+            await self._cfl.set_labels(job.cfl_id, self._labels(job.pagedata, job.is_root))
+
+        if not self._skip_restrictions:
+            await self._cfl.set_page_restrictions(job.cfl_id)
+            logger.info('  Restrictions applied')
+
+        self._write_done(job, uploaded)
+
+    async def _upload_attachments(self, job):
+        files = self._upload_files(job)
+        if not files:
+            return True
+
+        results = await self._cfl.upload_attachments(job.cfl_id, files,
+                                                     attachments=job.attachments)
+
+        return self._uploaded(job, results)
+
+    async def _index_remote_pages(self):
+        cfl_children = await self._get_children(self._report.keys())
+
+        children_ids = self._children_to_delete(cfl_children)
+        if children_ids:
+            await self._delete_pages(children_ids, 'Deleting children')
+            cfl_children = await self._get_children(self._report.keys())
+
+        self._index_children(cfl_children)
+
+        orphans = self._orphans_to_prune()
+        if orphans:
+            await self._delete_pages(orphans, 'Pruning orphans')
+
+    async def _get_children(self, cfl_pageids):
+        cfl_pageids = list(cfl_pageids)
+        replies = await asyncio.gather(*[self._cfl.get_children(cfl_pageid, expand=CHILDREN_EXPAND)
+                                         for cfl_pageid in cfl_pageids])
+
+        return {cfl_pageid: reply['results'] for cfl_pageid, reply in zip(cfl_pageids, replies)}
+
+    async def _delete_pages(self, cfl_ids, title):
+        if self._show_bars:
+            bar = IncrementalBar(f'{title} ({len(cfl_ids)})',
+                                 max=len(cfl_ids),
+                                 suffix='%(percent)d%%')
+
+        async def delete_page(cfl_id):
+            self._deleted(cfl_id, await self._cfl.delete_page(cfl_id))
+
+            if self._show_bars:
+                bar.next()
+
+        await asyncio.gather(*[delete_page(cfl_id) for cfl_id in cfl_ids])
+
+        if self._show_bars:
+            bar.finish()
+
+    async def _leased(self, cfl_pageids):
+        """Returns the pages whose lease could be acquired or refreshed"""
+        leased = await asyncio.gather(*[self._acquire_lease(cfl_pageid)
+                                        for cfl_pageid in cfl_pageids])
+
+        return [cfl_pageid for cfl_pageid, ok in zip(cfl_pageids, leased) if ok]
+
+    async def _acquire_lease(self, cfl_pageid):
+        self._lease_expires.pop(cfl_pageid, None)
+
+        lease = await self._cfl.get_property(cfl_pageid, LEASE_PROPERTY)
+        if not self._lease_available(cfl_pageid, lease):
+            return False
+
+        value = self._lease_value()
+        try:
+            acquired = await self._cfl.replace_property(cfl_pageid, LEASE_PROPERTY, value, lease)
+        except APIError as e:
+            logger.warning(f'Cannot lease root page id={cfl_pageid}, skipping it: {e}')
+            return False
+
+        return self._leased_until(cfl_pageid, value['expires'] if acquired else None)
+
+    async def _holds_lease(self, cfl_pageid):
+        if not self._shard:
+            return True
+
+        async with self._lease_lock:
+            if cfl_pageid not in self._lease_expires:
+                return False
+
+            return not self._lease_expiring(cfl_pageid) or await self._acquire_lease(cfl_pageid)
+
+    async def _release_leases(self):
+        if not self._shard:
+            return
+
+        for cfl_pageid in self._owned:
+            if self._owns_lease(await self._cfl.get_property(cfl_pageid, LEASE_PROPERTY)):
+                await self._cfl.delete_property(cfl_pageid, LEASE_PROPERTY)
+                logger.info(f'Released the lease on root page id={cfl_pageid}')
@@ -0,0 +1,108 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import abc
+
+
+class APIError(Exception):
+    pass
+
+
+class Backend(abc.ABC):
+    """Operations the processor requires to publish pages
+
+    Page ids are strings. Implementations raise APIError when an operation fails,
+    except where a boolean or None result is documented. A backend lacking any of the
+    operations cannot be instantiated.
+    """
+    @abc.abstractmethod
+    def create_page(self, parent_id, title, body, space_key=None, properties=None, labels=None):
+        """Creates a page with its properties and labels, returns a dict with its 'id'"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_space_key(self, page_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_page_by_name(self, space_key, name):
+        """Returns a dict whose 'results' list the pages with the given title"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_property(self, page_id, key):
+        """Returns a dict with the 'id', 'value' and 'version' of a property, None if unset"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_property(self, page_id, key, value):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace_property(self, page_id, key, value, prop):
+        """Sets the property unless it changed since prop (None if it was absent) was read
+
+        Returns False if another writer changed the property in the meantime.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_property(self, page_id, key):
+        """Returns True if the property has been deleted"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_page(self, page_id):
+        """Returns True if the page has been deleted"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_children(self, page_id, expand=None):
+        """Returns a dict whose 'results' list the child pages, with their 'id' and 'metadata'"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_attachments(self, page_id):
+        """Returns a map filename -> dict with the 'id', 'last_updated' and 'comment'"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def upload_attachments(self, page_id, files, attachments=None):
+        """Uploads files given as (filepath, filename, comment), returns filename -> success"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_page_body(self, page_id):
+        """Returns the body of the page in storage format"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_page(self, page_id, title, body):
+        """Returns a dict with the new 'version' of the page"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def move_page(self, page_id, parent_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_labels(self, page_id, labels):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_page_restrictions(self, page_id):
+        raise NotImplementedError
@@ -16,51 +16,266 @@
 
 import os
 import json
+import time
+import uuid
 import logging
+import mimetypes
 
 import requests
 
+from md2cfl import tracing
+from md2cfl.backend import Backend, APIError
 
 logger = logging.getLogger(__name__)
 
 
 LIMIT_ENTRIES = 1000
+DEFAULT_POOL_SIZE = 10
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_REQUEST_SIZE = 32 * 1024 * 1024
+MAX_UPLOAD_REQUEST_FILES = 25
+
+
+class MultipartStream:
+    """Streams a multipart/form-data body from disk with a bounded memory footprint
+
+    Files are opened lazily, read in chunks of at most UPLOAD_CHUNK_SIZE bytes and
+    closed as soon as they are exhausted or when the stream is closed.
+    """
+    def __init__(self, fields, files):
+        """fields is a dict or a list of (name, value), files a list of (name, filename, path)"""
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self._parts = []
+
+        if isinstance(fields, dict):
+            fields = fields.items()
+
+        for name, value in fields:
+            if value is None:
+                continue
+            self._parts.append(self._header(name) + str(value).encode() + b'\r\n')
+
+        for name, filename, filepath in files:
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self._parts.append(self._header(name, filename, mimetype))
+            self._parts.append(filepath)
+            self._parts.append(b'\r\n')
+
+        self._parts.append(f'--{self.boundary}--\r\n'.encode())
+
+        self._length = sum(os.path.getsize(part) if not isinstance(part, bytes) else len(part)
+                           for part in self._parts)
+        self._current = None
+        self._buffer = b''
+
+    def _header(self, name, filename=None, mimetype=None):
+        header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"'
+        if filename is not None:
+            header += f'; filename="{filename}"\r\nContent-Type: {mimetype}'
+
+        return (header + '\r\n\r\n').encode()
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > UPLOAD_CHUNK_SIZE:
+            size = UPLOAD_CHUNK_SIZE
+
+        while not self._buffer:
+            if self._current is not None:
+                self._buffer = self._current.read(size)
+                if not self._buffer:
+                    self._current.close()
+                    self._current = None
+            elif self._parts:
+                part = self._parts.pop(0)
+                if isinstance(part, bytes):
+                    self._buffer = part
+                else:
+                    self._current = open(part, 'rb')
+            else:
+                return b''
+
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return chunk
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        self._parts = []
+        self._buffer = b''
+
+
+# Request payloads, shared with the asyncio client
+
+def create_page_payload(parent_id, title, body, space_key, properties=None, labels=None):
+    payload = {
+        'title': title,
+        'type': 'page',
+        'space': {
+            'key': space_key
+        },
+        'ancestors': [
+            {'id': parent_id},
+        ],
+        'body': {
+            'storage': {
+                'value': body,
+                'representation': 'storage'
+            }
+        }
+    }
+
+    if properties or labels:
+        payload['metadata'] = {
+            'properties': {key: {'key': key, 'value': value}
+                           for key, value in (properties or {}).items()},
+            'labels': [{'prefix': 'global', 'name': label} for label in labels or []],
+        }
+
+    return payload
+
+
+def update_page_payload(page_id, title, body, page_info):
+    return {
+        'id': page_id,
+        'type': 'page',
+        'title': title,
+        'version': {'number': page_info['version']['number'] + 1},
+        'body': {'storage':
+                     {'value': body,
+                      'representation': 'storage'}}
+    }
+
+
+def move_page_payload(page_id, parent_id, page_info):
+    return {
+        'id': page_id,
+        'type': 'page',
+        'title': page_info['title'],
+        'version': {'number': page_info['version']['number'] + 1,
+                    'minorEdit': True},
+        'ancestors': [
+            {'id': parent_id},
+        ],
+    }
+
+
+def property_payload(key, value, prop):
+    """prop is the current property, None if it doesn't exist yet"""
+    if prop is None:
+        return {
+            'key': key,
+            'value': value
+        }
+    else:
+        return {
+            'id': prop['id'],
+            'key': key,
+            'value': value,
+            'version': {
+                'number': prop['version']['number'] + 1,
+                'minorEdit': True
+            }
+        }
+
+
+def labels_payload(labels):
+    return [{'prefix': 'global', 'name': label} for label in labels]
+
+
+def restrictions_payload(user):
+    return [
+        {
+            'operation': 'update',
+            'restrictions': {
+                'user': [
+                    {
+                        'type': 'known',
+                        'username': user
+                    }
+                ]
+            }
+        }
+    ]
+
+
+def parse_attachments(results):
+    return {result['title']: {'id': result['id'],
+                              'last_updated': result['version']['when'],
+                              'comment': result.get('metadata', {}).get('comment')}
+            for result in results}
 
 
-class APIError(Exception):
-    pass
+def upload_stream(files):
+    """Multipart body uploading files, given as (filepath, filename, comment)"""
+    fields = [('comment', comment or '') for _, _, comment in files] + [('minorEdit', 'false')]
 
+    return MultipartStream(fields=fields,
+                           files=[('file', filename, filepath) for filepath, filename, _ in files])
 
-class ConfluenceAPI:
-    def __init__(self, user, password, base_url):
+
+def batch_files(files, max_request_size):
+    """Groups files, given as (filepath, filename, comment), in batches to upload together"""
+    batch = []
+    batch_size = 0
+
+    for item in files:
+        size = os.path.getsize(item[0])
+
+        if batch and (batch_size + size > max_request_size or
+                      len(batch) >= MAX_UPLOAD_REQUEST_FILES):
+            yield batch
+            batch = []
+            batch_size = 0
+
+        batch.append(item)
+        batch_size += size
+
+    if batch:
+        yield batch
+
+
+class ConfluenceAPI(Backend):
+    def __init__(self, user, password, base_url, pool_size=DEFAULT_POOL_SIZE, tracer=None):
         self._user = user
         self._password = password
         self._base_url = base_url if base_url[-1] == '/' else base_url + '/'
+        self._tracer = tracer or tracing.NULL_TRACER
 
-    def create_page(self, parent_id, title, body):
-        parent_info = self.get_page_info(parent_id)
+        self._session = requests.Session()
+        self._session.auth = (user, password)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
-        logger.debug(f'Creating new page under space={parent_info["space"]["key"]}')
+    def create_page(self, parent_id, title, body, space_key=None, properties=None, labels=None):
+        if space_key is None:
+            space_key = self.get_space_key(parent_id)
+
+        logger.debug(f'Creating new page under space={space_key}')
 
-        payload = {
-            'title': title,
-            'type': 'page',
-            'space': {
-                'key': parent_info['space']['key']
-            },
-            'ancestors': [
-                {'id': parent_id},
-            ],
-            'body': {
-                'storage': {
-                    'value': body,
-                    'representation': 'storage'
-                }
-            }
-        }
         r = self._perform_json_request('POST',
                                        path='/content',
-                                       data=payload)
+                                       data=create_page_payload(parent_id, title, body, space_key,
+                                                                properties, labels))
 
         logger.debug(f'Created new page result={r}')
 
@@ -91,6 +306,13 @@ class ConfluenceAPI:
         else:
             return r.json()
 
+    def delete_property(self, page_id, key):
+        r = self._perform_request('DELETE',
+                                  path=f'/content/{page_id}/property/{key}',
+                                  raise_exception=False)
+
+        return r.status_code in (200, 204)
+
     def delete_page(self, page_id):
         r = self._perform_request('DELETE',
                                   path=f'/content/{page_id}',
@@ -98,41 +320,41 @@ class ConfluenceAPI:
 
         return r.status_code in (200, 204)
 
-    def get_children(self, page_id):
+    def get_children(self, page_id, expand=None):
+        params = {'limit': LIMIT_ENTRIES}
+        if expand:
+            params['expand'] = expand
+
         r = self._perform_request('GET',
                                   path=f'/content/{page_id}/child/page',
-                                  params={'limit': LIMIT_ENTRIES})
+                                  params=params)
 
         return r.json()
 
     def set_property(self, page_id, key, value):
         prop = self.get_property(page_id, key)
 
-        if prop is None:
-            payload = {
-                'key': key,
-                'value': value
-            }
+        r = self._perform_json_request('POST' if prop is None else 'PUT',
+                                       path=f'/content/{page_id}/property/{key}',
+                                       data=property_payload(key, value, prop))
 
-            r = self._perform_json_request('POST',
-                                           path=f'/content/{page_id}/property/{key}',
-                                           data=payload)
-        else:
-            payload = {
-                'id': prop['id'],
-                'key': key,
-                'value': value,
-                'version': {
-                    'number': prop['version']['number'] + 1,
-                    'minorEdit': True
-                }
-            }
+        return r
 
-            r = self._perform_json_request('PUT',
-                                           path=f'/content/{page_id}/property/{key}',
-                                           data=payload)
+    def replace_property(self, page_id, key, value, prop):
+        # The version of a PUT must follow the current one, a POST fails if the property exists
+        r = self._perform_request('POST' if prop is None else 'PUT',
+                                  path=f'/content/{page_id}/property/{key}',
+                                  headers={'Accept': 'application/json',
+                                           'Content-Type': 'application/json'},
+                                  data=json.dumps(property_payload(key, value, prop)),
+                                  raise_exception=False)
 
-        return r
+        if r.status_code == 409:
+            return False
+        elif r.status_code != 200:
+            raise APIError(f'Error code={r.status_code} url={r.url} text={r.text}')
+
+        return True
 
     def get_last_updated(self, content_id):
         r = self._perform_request('GET',
@@ -141,21 +363,15 @@ class ConfluenceAPI:
         return r.json()['lastUpdated']['when']
 
     def get_attachments(self, page_id):
-        attachments = {}
         r = self._perform_request('GET',
-                                  path=f'/content/{page_id}/child/attachment')
-
-        results = r.json()['results']
-        for result in results:
-            last_updated = self.get_last_updated(result['id'])
+                                  path=f'/content/{page_id}/child/attachment',
+                                  params={'limit': LIMIT_ENTRIES, 'expand': 'version,metadata'})
 
-            attachments[result['title']] = {'id': result['id'], 'last_updated': last_updated}
+        return parse_attachments(r.json()['results'])
 
-        return attachments
-
-    def upload_attachment(self, page_id, filepath, comment=None):
+    def upload_attachment(self, page_id, filepath, comment=None, filename=None):
         attachments = self.get_attachments(page_id)
-        filename = os.path.basename(filepath)
+        filename = filename or os.path.basename(filepath)
 
         if filename in attachments.keys():
             urlpath = f'/content/{page_id}/child/attachment/{attachments[filename]["id"]}/data'
@@ -164,16 +380,72 @@ class ConfluenceAPI:
             urlpath = f'/content/{page_id}/child/attachment'
             logger.debug('New file')
 
-        r = self._perform_request('POST',
-                                  path=urlpath,
-                                  headers={'X-Atlassian-Token': 'no-check'},
-                                  data={'comment': comment, 'minorEdit': 'false'},
-                                  files={'file': open(filepath, 'rb')})
+        r = self._post_files(urlpath, [(filepath, filename, comment)])
 
         logger.debug(f'Upload file={filename} to page_id={page_id} result={r.status_code}')
 
         return r.json()
 
+    def upload_attachments(self, page_id, files, attachments=None,
+                           max_request_size=MAX_UPLOAD_REQUEST_SIZE):
+        """Uploads several files, given as (filepath, filename, comment), to a page
+
+        New files are grouped in multipart requests of at most max_request_size bytes,
+        files replacing existing attachments are uploaded one by one. attachments, as
+        returned by get_attachments(), spares listing them if already known.
+
+        Returns a map filename -> True if the upload succeeded, False otherwise.
+        """
+        if attachments is None:
+            attachments = self.get_attachments(page_id)
+
+        results = {}
+        new_files = []
+
+        for filepath, filename, comment in files:
+            if filename in attachments:
+                urlpath = f'/content/{page_id}/child/attachment/{attachments[filename]["id"]}/data'
+                try:
+                    self._post_files(urlpath, [(filepath, filename, comment)])
+                except APIError as e:
+                    logger.warning(f'Cannot upload file={filename} to page_id={page_id}: {e}')
+                    results[filename] = False
+                else:
+                    results[filename] = True
+            else:
+                new_files.append((filepath, filename, comment))
+
+        for batch in batch_files(new_files, max_request_size):
+            try:
+                r = self._post_files(f'/content/{page_id}/child/attachment', batch)
+            except APIError as e:
+                logger.warning(f'Cannot upload files={[item[1] for item in batch]} '
+                               f'to page_id={page_id}: {e}')
+                uploaded = set()
+            else:
+                uploaded = {result['title'] for result in r.json()['results']}
+
+            for _, filename, _ in batch:
+                results[filename] = filename in uploaded
+
+        return results
+
+    def _post_files(self, urlpath, files):
+        """Streams files, given as (filepath, filename, comment), in a single request"""
+        with upload_stream(files) as stream:
+            started = time.monotonic()
+            r = self._perform_request('POST',
+                                      path=urlpath,
+                                      headers={'X-Atlassian-Token': 'no-check',
+                                               'Content-Type': stream.content_type},
+                                      data=stream)
+            elapsed = time.monotonic() - started
+
+        logger.info(f'Uploaded files={len(files)} size={len(stream)} time={elapsed:.2f}s '
+                    f'throughput={len(stream) / max(elapsed, 1e-6) / 1024:.1f}KiB/s')
+
+        return r
+
     def get_page_info(self, page_id):
         r = self._perform_request('GET',
                                   path=f'/content/{page_id}')
@@ -190,57 +462,43 @@ class ConfluenceAPI:
     def update_page(self, page_id, title, body):
         page_info = self.get_page_info(page_id)
 
-        version_number = page_info['version']['number'] + 1
+        logger.debug(f'Updating page id={page_id} title={title} '
+                     f'new version={page_info["version"]["number"] + 1}')
 
-        logger.debug(f'Updating page id={page_id} title={title} new version={version_number}')
+        reply = self._perform_json_request('PUT',
+                                           path=f'/content/{page_id}',
+                                           data=update_page_payload(page_id, title, body, page_info))
 
-        payload = {
-            'id': page_id,
-            'type': 'page',
-            'title': title,
-            'version': {'number': version_number},
-            'body': {'storage':
-                         {'value': body,
-                          'representation': 'storage'}}
-        }
+        logger.debug(f'Page updated successfully (reply={reply})')
+
+        return reply
+
+    def move_page(self, page_id, parent_id):
+        page_info = self.get_page_info(page_id)
+
+        logger.debug(f'Moving page id={page_id} under parent id={parent_id}')
 
         reply = self._perform_json_request('PUT',
                                            path=f'/content/{page_id}',
-                                           data=payload)
+                                           data=move_page_payload(page_id, parent_id, page_info))
 
-        logger.debug(f'Page updated successfully (reply={reply})')
+        logger.debug(f'Page moved successfully (reply={reply})')
 
         return reply
 
     def set_labels(self, page_id, labels):
-        labels_dicts = [{'prefix': 'global', 'name': label} for label in labels]
-
         reply = self._perform_json_request('POST',
                                            path=f'/content/{page_id}/label',
-                                           data=labels_dicts)
+                                           data=labels_payload(labels))
 
         logger.debug(f'Added labels {labels} to page id={page_id} (reply={reply})')
 
         return reply
 
     def set_page_restrictions(self, page_id):
-        payload = [
-            {
-                'operation': 'update',
-                'restrictions': {
-                    'user': [
-                        {
-                            'type': 'known',
-                            'username': self._user
-                        }
-                    ]
-                }
-            }
-        ]
-
         reply = self._perform_json_request('PUT',
                                            path=f'/content/{page_id}/restriction',
-                                           data=payload,
+                                           data=restrictions_payload(self._user),
                                            experimental_api=True)
 
         logger.debug(f'Setting page restriction to page id={page_id} for user={self._user} '
@@ -255,7 +513,9 @@ class ConfluenceAPI:
         else:
             url = self._base_url + 'rest/api' + path
 
-        r = requests.request(method, url=url, auth=(self._user, self._password), headers=headers, data=data, **kwargs)
+        with self._tracer.span(f'{method} {path}', category='http') as span_args:
+            r = self._session.request(method, url=url, headers=headers, data=data, **kwargs)
+            span_args['status'] = r.status_code
 
         if r.status_code == 200 or not raise_exception:
             return r
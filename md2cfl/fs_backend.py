@@ -0,0 +1,290 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import datetime
+import threading
+from pathlib import Path
+
+from md2cfl.backend import Backend, APIError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPACE_KEY = 'LOCAL'
+# Same as processor.ELID_PROPERTY, not imported to keep the sink free of the processor
+ELID_PROPERTY = 'md_elid'
+
+
+class FilesystemBackend(Backend):
+    """Publishes the pages to a local directory instead of a Confluence server
+
+    Each page is stored in pages/<page id>/:
+
+    * page.json: title, parent id, space key, version, labels, properties, restrictions
+    * body.xml: the body in storage format
+    * attachments/: the attached files, their comments in attachments.json
+
+    Pages referenced but never created, such as the root pages, are assumed to exist.
+    Pages carrying an md_elid property get an id derived from it, so that the trees
+    produced from two revisions of a report can be compared file by file.
+    """
+    def __init__(self, root_dir, space_key=DEFAULT_SPACE_KEY):
+        self._pages_dir = Path(root_dir) / 'pages'
+        self._space_key = space_key
+        self._lock = threading.Lock()
+
+        self._pages_dir.mkdir(parents=True, exist_ok=True)
+
+        self._pages = {}
+        for page_file in self._pages_dir.glob('*/page.json'):
+            with open(page_file) as f:
+                page = json.load(f)
+            self._pages[page['id']] = page
+
+        logger.info(f'Loaded {len(self._pages)} pages from {self._pages_dir}')
+
+    def create_page(self, parent_id, title, body, space_key=None, properties=None, labels=None):
+        with self._lock:
+            page_id = self._new_page_id((properties or {}).get(ELID_PROPERTY))
+
+            page = self._page(page_id)
+            page.update({
+                'title': title,
+                'parent': str(parent_id),
+                'space': space_key or self._page(parent_id)['space'],
+                'labels': sorted(set(labels or [])),
+                'properties': {key: {'id': key, 'value': value, 'version': {'number': 1}}
+                               for key, value in (properties or {}).items()},
+            })
+
+            self._save(page, body=body)
+
+        logger.debug(f'Created page id={page_id} title={title}')
+
+        return {'id': page_id}
+
+    def get_space_key(self, page_id):
+        with self._lock:
+            return self._page(page_id)['space']
+
+    def get_page_by_name(self, space_key, name):
+        with self._lock:
+            return {'results': [{'id': page['id'], 'title': page['title']}
+                                for page in self._pages.values()
+                                if page['space'] == space_key and page['title'] == name]}
+
+    def get_property(self, page_id, key):
+        with self._lock:
+            prop = self._page(page_id)['properties'].get(key)
+
+            return dict(prop, key=key) if prop else None
+
+    def set_property(self, page_id, key, value):
+        with self._lock:
+            page = self._page(page_id)
+            prop = page['properties'].get(key)
+            version = prop['version']['number'] + 1 if prop else 1
+
+            page['properties'][key] = {'id': key, 'value': value, 'version': {'number': version}}
+            self._save(page)
+
+            return dict(page['properties'][key], key=key)
+
+    def replace_property(self, page_id, key, value, prop):
+        with self._lock:
+            page = self._page(page_id)
+            current = page['properties'].get(key)
+            version = current['version']['number'] if current else None
+
+            if version != (prop['version']['number'] if prop else None):
+                return False
+
+            page['properties'][key] = {'id': key, 'value': value,
+                                       'version': {'number': (version or 0) + 1}}
+            self._save(page)
+
+            return True
+
+    def delete_property(self, page_id, key):
+        with self._lock:
+            page = self._page(page_id)
+            if page['properties'].pop(key, None) is None:
+                return False
+
+            self._save(page)
+
+            return True
+
+    def delete_page(self, page_id):
+        with self._lock:
+            page_id = str(page_id)
+            page = self._pages.pop(page_id, None)
+            if page is None:
+                return False
+
+            # As on Confluence, the children of a deleted page move up to its parent
+            for child in self._pages.values():
+                if child['parent'] == page_id:
+                    child['parent'] = page['parent']
+                    self._save(child)
+
+            shutil.rmtree(self._pages_dir / page_id, ignore_errors=True)
+
+            return True
+
+    def get_children(self, page_id, expand=None):
+        with self._lock:
+            return {'results': [{'id': page['id'],
+                                 'title': page['title'],
+                                 'metadata': {'properties': {
+                                     key: {'key': key, 'value': prop['value']}
+                                     for key, prop in page['properties'].items()}}}
+                                for page in self._pages.values()
+                                if page['parent'] == str(page_id)]}
+
+    def get_attachments(self, page_id):
+        attachments_dir = self._pages_dir / str(page_id) / 'attachments'
+
+        with self._lock:
+            comments = self._read_json(attachments_dir / 'attachments.json', {})
+
+        attachments = {}
+        for filename, comment in comments.items():
+            mtime = os.stat(attachments_dir / filename).st_mtime
+            attachments[filename] = {
+                'id': filename,
+                'last_updated': datetime.datetime.fromtimestamp(
+                    mtime, datetime.timezone.utc).isoformat(),
+                'comment': comment,
+            }
+
+        return attachments
+
+    def upload_attachments(self, page_id, files, attachments=None):
+        attachments_dir = self._pages_dir / str(page_id) / 'attachments'
+        attachments_dir.mkdir(parents=True, exist_ok=True)
+
+        results = {}
+        for filepath, filename, _ in files:
+            try:
+                shutil.copyfile(filepath, attachments_dir / filename)
+            except OSError as e:
+                logger.warning(f'Cannot copy file={filename} to page_id={page_id}: {e}')
+                results[filename] = False
+            else:
+                results[filename] = True
+
+        with self._lock:
+            comments = self._read_json(attachments_dir / 'attachments.json', {})
+            comments.update({filename: comment for _, filename, comment in files
+                             if results[filename]})
+            self._write_json(attachments_dir / 'attachments.json', comments)
+
+        return results
+
+    def get_page_body(self, page_id):
+        body_file = self._pages_dir / str(page_id) / 'body.xml'
+
+        return body_file.read_text(encoding='utf-8') if body_file.exists() else ''
+
+    def update_page(self, page_id, title, body):
+        with self._lock:
+            page = self._page(page_id)
+            page['title'] = title
+            page['version'] += 1
+
+            self._save(page, body=body)
+
+            return {'id': page['id'], 'version': {'number': page['version']}}
+
+    def move_page(self, page_id, parent_id):
+        with self._lock:
+            page = self._page(page_id)
+            page['parent'] = str(parent_id)
+            page['version'] += 1
+
+            self._save(page)
+
+            return {'id': page['id'], 'version': {'number': page['version']}}
+
+    def set_labels(self, page_id, labels):
+        with self._lock:
+            page = self._page(page_id)
+            merged = sorted(set(page['labels']) | set(labels))
+
+            if merged != page['labels']:
+                page['labels'] = merged
+                self._save(page)
+
+    def set_page_restrictions(self, page_id):
+        with self._lock:
+            page = self._page(page_id)
+            if not page['restricted']:
+                page['restricted'] = True
+                self._save(page)
+
+    def _page(self, page_id):
+        page_id = str(page_id)
+
+        if page_id not in self._pages:
+            self._pages[page_id] = {
+                'id': page_id,
+                'title': None,
+                'parent': None,
+                'space': self._space_key,
+                'version': 1,
+                'labels': [],
+                'properties': {},
+                'restricted': False,
+            }
+
+        return self._pages[page_id]
+
+    def _new_page_id(self, elid):
+        if elid is None:
+            return uuid.uuid4().hex[:16]
+
+        page_id = hashlib.sha256(elid.encode()).hexdigest()[:16]
+        if page_id in self._pages:
+            raise APIError(f'A page with id={page_id} already exists for md_elid={elid}')
+
+        return page_id
+
+    def _save(self, page, body=None):
+        page_dir = self._pages_dir / page['id']
+        page_dir.mkdir(exist_ok=True)
+
+        self._write_json(page_dir / 'page.json', page)
+
+        if body is not None:
+            (page_dir / 'body.xml').write_text(body, encoding='utf-8')
+
+    def _read_json(self, filepath, default):
+        if not filepath.exists():
+            return default
+
+        with open(filepath) as f:
+            return json.load(f)
+
+    def _write_json(self, filepath, value):
+        with open(filepath, 'w') as f:
+            json.dump(value, f, indent=2, sort_keys=True)
+            f.write('\n')
@@ -0,0 +1,121 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import logging
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from md2cfl import utils
+
+logger = logging.getLogger(__name__)
+
+# Bump when the optimization steps change, invalidates the cached results
+OPTIMIZER_VERSION = 2
+OPTIMIZABLE_SUFFIXES = ('.png',)
+
+
+def _optimize_image(source, target, max_size, strip_metadata):
+    from PIL import Image
+
+    with Image.open(source) as image:
+        image.load()
+        params = {'format': 'PNG', 'optimize': True}
+
+        if strip_metadata:
+            # The PNG writer falls back to the profile of the source image otherwise
+            params['icc_profile'] = None
+        else:
+            for key in ('dpi', 'icc_profile', 'exif'):
+                if key in image.info:
+                    params[key] = image.info[key]
+
+        downscaled = bool(max_size) and max(image.size) > max_size
+        if downscaled:
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+        tmp_target = target.with_suffix('.tmp')
+        image.save(tmp_target, **params)
+
+    # Never replace the original with something bigger if no downscaling took place
+    if not downscaled and tmp_target.stat().st_size >= source.stat().st_size:
+        shutil.copyfile(source, tmp_target)
+
+    os.replace(tmp_target, target)
+
+    return source.stat().st_size, target.stat().st_size
+
+
+class ImageOptimizer:
+    def __init__(self, cache_dir=None, max_size=None, strip_metadata=True, workers=None):
+        self._cache_dir = Path(cache_dir) if cache_dir else utils.cache_dir() / 'images'
+        self._max_size = max_size
+        self._strip_metadata = strip_metadata
+        self._workers = workers
+
+    def optimize(self, images):
+        """Returns a map source path -> path of the optimized file to be uploaded"""
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            logger.warning('Pillow is not installed, image optimization is disabled')
+            return {}
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+        optimized = {}
+        todo = {}
+        for image in set(images):
+            image = Path(image)
+            if image.suffix.lower() not in OPTIMIZABLE_SUFFIXES or not image.exists():
+                continue
+
+            target = self._cache_dir / f'{self._cache_key(image)}{image.suffix.lower()}'
+            optimized[image] = target
+
+            if not target.exists():
+                todo[image] = target
+
+        logger.info(f'Image optimization: cached={len(optimized) - len(todo)} todo={len(todo)}')
+
+        if todo:
+            saved = 0
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                futures = {executor.submit(_optimize_image, source, target,
+                                           self._max_size, self._strip_metadata): source
+                           for source, target in todo.items()}
+
+                for future, source in futures.items():
+                    try:
+                        size_before, size_after = future.result()
+                    except Exception as e:
+                        logger.warning(f'Cannot optimize image {source}, uploading it as is: {e}')
+                        del optimized[source]
+                    else:
+                        saved += size_before - size_after
+                        logger.debug(f'Optimized {source} size={size_before} -> {size_after}')
+
+            logger.info(f'Image optimization saved {saved} bytes')
+
+        return optimized
+
+    def _cache_key(self, image):
+        hash = hashlib.sha256(utils.file_digest(image).encode())
+        hash.update(f'{OPTIMIZER_VERSION}:{self._max_size}:{self._strip_metadata}'.encode())
+
+        return hash.hexdigest()
@@ -0,0 +1,106 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from md2cfl import utils
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Write-ahead journal of the pages published by a run, one JSON record per line
+
+    Operations are recorded before being issued ('begin') and once the page has been
+    completely published ('done'), so that an interrupted run can be resumed without
+    publishing its completed pages again.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.completed = {}
+        self.in_flight = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_reports(cls, report_files, target, shard=None):
+        """Returns the journal of a run publishing the reports to target (URL or directory)"""
+        key = hashlib.sha256('\n'.join(sorted(os.path.abspath(report_file)
+                                              for report_file in report_files)).encode())
+        # Workers of different shards, or publishing to different instances, may share
+        # the same cache directory
+        key.update(f'target={target}'.encode())
+        key.update(f'shard={shard}'.encode())
+
+        return cls(utils.cache_dir() / 'journals' / f'{key.hexdigest()}.jsonl')
+
+    def open(self, resume):
+        """Opens the journal, loading the records of the previous run if resuming"""
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        if resume and self.filepath.exists():
+            self._load()
+            logger.info(f'Resuming from journal {self.filepath}: completed={len(self.completed)} '
+                        f'in flight={len(self.in_flight)}')
+        elif resume:
+            logger.warning('No journal to resume from, starting from scratch')
+
+        self._file = open(self.filepath, 'a' if resume else 'w')
+
+    def close(self, completed):
+        """Closes the journal, a completed run has nothing to resume and removes it"""
+        if self._file is None:
+            return
+
+        self._file.close()
+        self._file = None
+
+        if completed:
+            os.remove(self.filepath)
+
+    def begin(self, op, elid, **data):
+        self._write({'state': 'begin', 'op': op, 'elid': elid, **data})
+
+    def done(self, elid, page_hash):
+        self._write({'state': 'done', 'elid': elid, 'hash': page_hash})
+
+    def is_completed(self, elid, page_hash):
+        return self.completed.get(elid) == page_hash
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def _load(self):
+        with open(self.filepath) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record might be truncated by a crash
+                    logger.warning(f'Skipping corrupted journal record: {line!r}')
+                    continue
+
+                if record['state'] == 'begin':
+                    self.in_flight[record['elid']] = record
+                elif record['state'] == 'done':
+                    self.in_flight.pop(record['elid'], None)
+                    self.completed[record['elid']] = record['hash']
@@ -0,0 +1,192 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import queue
+import logging
+import threading
+
+from md2cfl import tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 16
+
+_END = object()
+
+
+class Stage:
+    """A step of a pipeline, run by one or more worker threads
+
+    func is called with each input item and returns an iterable of output items.
+    finish, if given, is called once all the input items have been processed and
+    returns an iterable of additional output items.
+    """
+    def __init__(self, name, func, workers=1, finish=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.finish = finish
+
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f'<Stage {self.name} workers={self.workers} in={self.items_in} '
+                f'out={self.items_out} busy={self.busy_time:.2f}s wait={self.wait_time:.2f}s>')
+
+
+class Pipeline:
+    """Runs a source iterable through a sequence of stages connected by bounded queues
+
+    Every stage works concurrently with the others, the bounded queues apply back
+    pressure to the faster upstream stages. An exception raised by any stage stops
+    the pipeline and is re-raised by run(), as is a KeyboardInterrupt once all the
+    stages have stopped.
+    """
+    def __init__(self, source, stages, maxsize=DEFAULT_QUEUE_SIZE, tracer=None):
+        self._source = source
+        self._stages = stages
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+        self._tracer = tracer or tracing.NULL_TRACER
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    def run(self):
+        # Daemon threads don't keep the process alive if stopping them is interrupted again
+        threads = [threading.Thread(target=self._feed, name='source', daemon=True)]
+
+        for index, stage in enumerate(self._stages):
+            remaining = [stage.workers]
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(index, stage, remaining),
+                                                name=f'{stage.name}-{worker}',
+                                                daemon=True))
+
+        threads.append(threading.Thread(target=self._drain, name='sink', daemon=True))
+
+        started = time.monotonic()
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt as e:
+            # Only the main thread receives the interruption, the stages are stopped and
+            # drained so that none of them keeps working while the caller cleans up
+            self._failed(e)
+
+            for thread in threads:
+                thread.join()
+
+            raise
+
+        elapsed = time.monotonic() - started
+
+        for stage in self._stages:
+            logger.info(f'Pipeline stage {stage.name}: workers={stage.workers} '
+                        f'in={stage.items_in} out={stage.items_out} '
+                        f'busy={stage.busy_time:.2f}s '
+                        f'utilization={stage.busy_time / max(elapsed * stage.workers, 1e-6):.0%} '
+                        f'throughput={stage.items_in / max(elapsed, 1e-6):.1f}/s')
+
+        if self._error:
+            raise self._error
+
+    def _failed(self, error):
+        with self._error_lock:
+            if self._error is None:
+                logger.error(f'Pipeline aborted: {error!r}')
+                self._error = error
+
+    def _feed(self):
+        try:
+            for item in self._source:
+                if self._error:
+                    break
+                self._queues[0].put(item)
+        except BaseException as e:
+            self._failed(e)
+        finally:
+            for _ in range(self._stages[0].workers):
+                self._queues[0].put(_END)
+
+    def _work(self, index, stage, remaining):
+        input_queue = self._queues[index]
+        output_queue = self._queues[index + 1]
+
+        while True:
+            started = time.monotonic()
+            item = input_queue.get()
+            waited = time.monotonic() - started
+
+            if item is _END:
+                break
+
+            # After a failure the queues are drained without processing, so that the
+            # upstream stages never block on a full queue
+            if self._error:
+                continue
+
+            started = time.monotonic()
+            try:
+                with self._tracer.span(stage.name, category='pipeline'):
+                    results = list(stage.func(item))
+            except BaseException as e:
+                self._failed(e)
+                results = []
+            busy = time.monotonic() - started
+
+            with stage._lock:
+                stage.items_in += 1
+                stage.items_out += len(results)
+                stage.busy_time += busy
+                stage.wait_time += waited
+
+            for result in results:
+                output_queue.put(result)
+
+        with stage._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+
+        if last:
+            if stage.finish and not self._error:
+                try:
+                    with self._tracer.span(f'{stage.name} finish', category='pipeline'):
+                        results = list(stage.finish())
+                except BaseException as e:
+                    self._failed(e)
+                    results = []
+
+                stage.items_out += len(results)
+                for result in results:
+                    output_queue.put(result)
+
+            next_workers = (self._stages[index + 1].workers
+                            if index + 1 < len(self._stages) else 1)
+            for _ in range(next_workers):
+                output_queue.put(_END)
+
+    def _drain(self):
+        while self._queues[-1].get() is not _END:
+            pass
@@ -16,42 +16,230 @@
 
 import logging
 import os
+import time
+import socket
+import hashlib
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import dateutil.parser
 from progress.bar import IncrementalBar
 
-from md2cfl import renderer, utils
-from md2cfl.confluence_api import APIError
+from md2cfl import renderer, utils, tracing, pipeline, scheduler
+from md2cfl.backend import APIError
 
 logger = logging.getLogger(__name__)
 
+ELID_PROPERTY = 'md_elid'
+LEASE_PROPERTY = 'md_lease'
+# Children are retrieved with the property identifying the pages of the importer
+CHILDREN_EXPAND = f'metadata.properties.{ELID_PROPERTY}'
+DEFAULT_JOBS = 4
+DEFAULT_LEASE_TTL = 3600
+
+
+class PageJob:
+    """A page to be published, filled in by the render, fetch and write steps"""
+    def __init__(self, pagedata, version_info, cfl_root_pageid, is_root=False):
+        self.pagedata = pagedata
+        self.version_info = version_info
+        self.cfl_root_pageid = cfl_root_pageid
+        self.is_root = is_root
+
+        # Page id and current parent id, None if the page has to be created
+        self.cfl_id = cfl_root_pageid if is_root else None
+        self.cfl_parent_id = None
+
+        self.page_hash = None
+        self.body = None
+        self.up_to_date = False
+        self.attachments = {}
+        self.attachments_todo = []
+
+        # Images attached to another page -> (filename, title, space key)
+        self.attachment_refs = {}
+
 
 class Processor:
-    def __init__(self, cfl, version_info, report, skip_restrictions,
-                 force_updates, delete_children, print_summary):
+    def __init__(self, cfl, reports, skip_restrictions,
+                 force_updates, delete_children, print_summary, img_optimizer=None,
+                 prune=False, jobs=DEFAULT_JOBS, tracer=None, shard=None,
+                 lease_ttl=DEFAULT_LEASE_TTL, pipelined=False, journal=None,
+                 dedupe_images=False):
+        """reports is an iterable of (report file, version info, root page id, root page)
+
+        shard is an optional (index, count) tuple, index starting from 1: only the root
+        pages belonging to the shard are processed, each guarded by a lease.
+
+        When pipelined, reports is consumed lazily and parsing, rendering, fetching the
+        remote state and writing run concurrently as stages of a pipeline.
+
+        Published pages are recorded in the journal, if given. Pages already completed
+        according to the journal, with the same hash, are skipped.
+
+        With dedupe_images, an image found on several pages is uploaded only to the first
+        page rendered, the other pages reference the attachment of that page.
+        """
         self._cfl = cfl
-        self._version_info = version_info
-        self._report = report
+        self._reports = reports
         self._skip_restrictions = skip_restrictions
         self._force_updates = force_updates
         self._delete_children = delete_children
         self._print_summary = print_summary
+        self._img_optimizer = img_optimizer
+        self._prune = prune
+        self._jobs = jobs
+        self._tracer = tracer or tracing.NULL_TRACER
+        self._shard = shard
+        self._lease_ttl = lease_ttl
+        self._lease_owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._lease_expires = {}
+        self._lease_lock = threading.Lock()
+        self._pipelined = pipelined
+        self._journal = journal
+        self._dedupe_images = dedupe_images
+        self._show_bars = print_summary and not pipelined
+        self._owned = []
+        self._upload_paths = {}
+        self._image_owners = {}
+        self._remote_pages = {}
+        self._children = {}
+        self._space_keys = {}
         self._summary = {}
         self._errors = []
         self._renderer = renderer.Renderer()
         self._current_bar = None
+        self._lock = threading.Lock()
+
+        # Root pages of all the reports are scheduled together
+        self._report = {}
+        self._version_infos = {}
+        self._report_files = {}
+        self._target_roots = {}
+        self._conflicts = set()
+        self._deferred = []
 
     def process(self):
+        """Returns True if all the pages have been published without errors"""
+        if self._pipelined:
+            self._process_pipelined()
+        else:
+            self._process_sequential()
+
+        self._print_report_summary()
+
+        return not self._errors
+
+    def _process_sequential(self):
+        for report_file, version_info, cfl_pageid, rootpage in self._reports:
+            self._add_root_page(report_file, version_info, cfl_pageid, rootpage)
+
+        self._owned = [cfl_pageid for cfl_pageid in self._report if self._in_shard(cfl_pageid)]
+
+        if self._shard:
+            self._owned = [cfl_pageid for cfl_pageid in self._owned
+                           if self._acquire_lease(cfl_pageid)]
+            logger.info(f'Shard {self._shard[0]}/{self._shard[1]} owns {len(self._owned)} '
+                        f'of {len(self._report)} root pages')
+
+        try:
+            self._process_owned()
+        finally:
+            self._release_leases()
+
+    def _process_owned(self):
         if self._print_summary:
-            print(f'Starting MDImporter processing on {len(self._report)} root pages')
+            print(f'Starting MDImporter processing on {len(self._owned)} root pages')
+
+        if self._img_optimizer:
+            with self._tracer.span('optimize images'):
+                self._upload_paths = self._img_optimizer.optimize(
+                    self._all_images(self._report[cfl_pageid] for cfl_pageid in self._owned))
+
+        with self._tracer.span('index remote pages'):
+            self._index_remote_pages()
+
+        if self._jobs > 1:
+            self._process_scheduled()
+            return
 
-        for cfl_pageid, rootpage in self._report.items():
-            self._process_root_page(cfl_pageid, rootpage)
+        for cfl_pageid in self._owned:
+            rootpage = self._report[cfl_pageid]
 
+            # Refresh the lease, another worker may have taken it over if it expired
+            if self._shard and not self._acquire_lease(cfl_pageid):
+                continue
+
+            with self._tracer.span('rootpage', pageid=cfl_pageid,
+                                   qualname=rootpage.pagedata.qualifiedName):
+                self._process_root_page(cfl_pageid)
+
+    def _process_scheduled(self):
+        """Renders and fetches all the pages, then writes them the most expensive first
+
+        Pages requiring no update only get their labels and restrictions applied, they
+        run on the fast lane of the scheduler. The steps of a page run at different times
+        on different threads, each one is traced in a page span of its own.
+        """
+        jobs = []
+        for cfl_pageid in self._owned:
+            rootpage = self._report[cfl_pageid]
+
+            with self._tracer.span('rootpage', pageid=cfl_pageid,
+                                   qualname=rootpage.pagedata.qualifiedName):
+                for job in self._page_jobs(cfl_pageid):
+                    with self._page_span(job):
+                        if not job.is_root:
+                            self._resolve(job)
+
+                        self._render(job)
+
+                    if not self._is_completed(job):
+                        jobs.append(job)
+
+        with self._tracer.span('fetch pages', count=len(jobs)):
+            with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+                list(executor.map(self._fetch_page, jobs))
+
+        if self._show_bars:
+            bar = IncrementalBar(f'Publishing pages ({len(jobs)})',
+                                 max=len(jobs),
+                                 suffix='%(percent)d%%')
+
+        tasks = [scheduler.Task(self._estimate_cost(job), self._write_page, job) for job in jobs]
+        scheduler.Scheduler(self._jobs).run(tasks, on_done=bar.next if self._show_bars else None)
+
+        if self._show_bars:
+            bar.finish()
+
+    def _process_pipelined(self):
+        if self._print_summary:
+            print('Starting MDImporter pipelined processing')
+
+        stages = [
+            pipeline.Stage('render', self._render_root_page),
+            pipeline.Stage('fetch', self._fetch_root_page, workers=self._jobs,
+                           finish=self._fetch_deferred),
+            pipeline.Stage('write', self._write_page, workers=self._jobs),
+        ]
+
+        try:
+            pipeline.Pipeline(self._reports, stages, tracer=self._tracer).run()
+
+            # Orphans are known only once the whole report has been streamed, they are
+            # deleted while the leases still protect their root pages
+            orphans = self._orphans_to_prune()
+            if orphans:
+                self._delete_pages(orphans, 'Pruning orphans')
+        finally:
+            self._release_leases()
+
+    def _print_report_summary(self):
         if self._print_summary:
-            if any([item for v in self._summary.values() for item in v.values()]):
-                maxlen = max([len(qualname) for qualname in self._summary.keys()])
+            if self._errors or any([item for v in self._summary.values() for item in v.values()]):
+                maxlen = max([len(qualname) for qualname in
+                              list(self._summary.keys()) + [qualname for qualname, _ in self._errors]])
 
                 print('Updates summary:')
                 print(f'Qualified page name {" "*(maxlen-20)} | Updated | Updated diagrams')
@@ -69,157 +257,670 @@ class Processor:
             else:
                 print('No changes')
 
-    def _process_root_page(self, cfl_root_pageid, rootpage):
-        logger.info(f'Rootpage cfl_id={cfl_root_pageid}')
-        self._summary[rootpage.pagedata.qualifiedName] = {
-            'updated': False,
-            'updated_attachments': 0,
-            'errors': [],
-        }
-        self._update_page_contents(cfl_root_pageid, rootpage.pagedata, is_root=True)
-
-        cfl_children = self._cfl.get_children(cfl_root_pageid)
+    def _add_root_page(self, report_file, version_info, cfl_pageid, rootpage):
+        if cfl_pageid in self._report:
+            error = (f'Page id={cfl_pageid} is already targeted by '
+                     f'{self._report[cfl_pageid].pagedata.qualifiedName} '
+                     f'({self._report_files[cfl_pageid]}), skipping it')
+            logger.error(f'{rootpage.pagedata.qualifiedName} ({report_file}): {error}')
+            self._errors.append((rootpage.pagedata.qualifiedName, error))
+            self._conflicts.add(cfl_pageid)
+            return False
 
-        if self._delete_children and cfl_children['results']:
-            results = cfl_children['results']
-            bar = IncrementalBar(f'Deleting {len(results)} children',
-                                               max=len(results),
-                                               suffix='%(percent)d%%')
+        self._report[cfl_pageid] = rootpage
+        self._version_infos[cfl_pageid] = version_info
+        self._report_files[cfl_pageid] = report_file
 
-            for child in results:
-                self._cfl.delete_page(child['id'])
-                bar.next()
+        for subpage in rootpage.subpages:
+            self._target_roots[subpage.pagedata.elementid] = cfl_pageid
 
-            bar.finish()
+        return True
 
-            cfl_children = self._cfl.get_children(cfl_root_pageid)
+    def _page_jobs(self, cfl_root_pageid):
+        rootpage = self._report[cfl_root_pageid]
+        version_info = self._version_infos[cfl_root_pageid]
 
-        for subpage in rootpage.subpages:
-            pagedata = subpage.pagedata
+        jobs = [PageJob(rootpage.pagedata, version_info, cfl_root_pageid, is_root=True)]
+        jobs += [PageJob(subpage.pagedata, version_info, cfl_root_pageid)
+                 for subpage in rootpage.subpages]
 
-            self._summary[pagedata.qualifiedName] = {
+        for job in jobs:
+            self._summary[job.pagedata.qualifiedName] = {
                 'updated': False,
                 'updated_attachments': 0,
                 'errors': [],
             }
 
-            cfl_id = self._find_page_by_elid(cfl_children, pagedata.elementid)
+        return jobs
 
-            if not cfl_id:
-                try:
-                    newpage = self._cfl.create_page(cfl_root_pageid, pagedata.name, 'Initial import')
-                except APIError as e:
-                    logger.info(f'Cannot create page qualname={pagedata.qualifiedName} error={e}')
-                    self._errors.append((pagedata.qualifiedName, e))
-                    return
+    def _process_root_page(self, cfl_root_pageid):
+        logger.info(f'Rootpage cfl_id={cfl_root_pageid}')
 
-                cfl_id = newpage['id']
-                logger.info(f'  Created new page id={cfl_id}')
-                self._cfl.set_property(cfl_id, 'md_elid', pagedata.elementid)
+        for job in self._page_jobs(cfl_root_pageid):
+            if not job.is_root:
+                self._resolve(job)
 
-            self._update_page_contents(cfl_id, pagedata)
+            with self._page_span(job):
+                if self._show_bars:
+                    self._current_bar = IncrementalBar(
+                        f'Processing {job.pagedata.qualifiedName:64s}',
+                        max=self._total_steps(job.pagedata),
+                        suffix='%(percent)d%%')
 
-    def _update_page_contents(self, cfl_id, pagedata, is_root=False):
-        if self._print_summary:
-            self._current_bar = IncrementalBar(f'Processing {pagedata.qualifiedName:64s}',
-                                               max=self._total_steps(pagedata),
-                                               suffix='%(percent)d%%')
+                self._render(job)
 
-        page_hash = utils.generate_hash(pagedata)
-        body = self._renderer.render_page(pagedata=pagedata,
-                                          hash=page_hash,
-                                          version_info=self._version_info)
+                if not self._is_completed(job):
+                    self._fetch(job)
+                    self._write(job)
 
-        logger.info(f'Processing page: qualname={pagedata.qualifiedName} '
-                    f'elid={pagedata.elementid} '
-                    f'bodylen={len(body)}')
+                if self._show_bars:
+                    # Not sure why finish() doesn't complete the bar
+                    while self._current_bar.remaining > 0:
+                        self._current_bar.next()
+                    self._current_bar.finish()
+
+    def _render_root_page(self, entry):
+        """Pipeline stage: registers a parsed root page and renders all its pages"""
+        report_file, version_info, cfl_pageid, rootpage = entry
+
+        if not self._add_root_page(report_file, version_info, cfl_pageid, rootpage):
+            return []
+
+        if not self._in_shard(cfl_pageid):
+            return []
+
+        if self._img_optimizer:
+            self._upload_paths.update(self._img_optimizer.optimize(self._all_images([rootpage])))
+
+        jobs = self._page_jobs(cfl_pageid)
+        for job in jobs:
+            self._render(job)
+
+        return [(cfl_pageid, jobs)]
+
+    def _fetch_root_page(self, item):
+        """Pipeline stage: indexes the children of a root page and fetches the pages state
+
+        Sub-pages not found among the children are deferred until all the root pages have
+        been indexed, as they might have been moved from another root page.
+        """
+        cfl_pageid, jobs = item
+
+        if self._shard and not self._acquire_lease(cfl_pageid):
+            return []
+
+        with self._lock:
+            self._owned.append(cfl_pageid)
+
+        children = self._get_children([cfl_pageid])
+
+        if self._delete_children and children[cfl_pageid]:
+            self._delete_pages([cfl_child['id'] for cfl_child in children[cfl_pageid]],
+                               'Deleting children')
+            children = self._get_children([cfl_pageid])
+
+        self._index_children(children)
+
+        resolved = []
+        for job in jobs:
+            if self._is_completed(job):
+                continue
+
+            if not job.is_root and not self._resolve(job):
+                with self._lock:
+                    self._deferred.append(job)
+                continue
+
+            self._fetch(job)
+            resolved.append(job)
+
+        # The write workers pick up the most expensive pages of the batch first
+        return sorted(resolved, key=self._estimate_cost, reverse=True)
+
+    def _fetch_deferred(self):
+        for job in self._deferred:
+            self._resolve(job)
+            self._fetch(job)
+
+        return sorted(self._deferred, key=self._estimate_cost, reverse=True)
+
+    def _fetch_page(self, job):
+        with self._page_span(job):
+            self._fetch(job)
+
+    def _write_page(self, job):
+        """Pipeline stage: publishes a page"""
+        with self._page_span(job):
+            self._write(job)
+
+        return []
+
+    def _page_span(self, job):
+        return self._tracer.span('page', pageid=job.cfl_id, rootpageid=job.cfl_root_pageid,
+                                 qualname=job.pagedata.qualifiedName)
+
+    def _resolve(self, job):
+        """Looks the page of a sub-page up in the remote index, returns False if not found
+
+        A page whose creation was interrupted is found by its md_elid as well, the
+        page and its properties are created in one request.
+        """
+        job.cfl_id, job.cfl_parent_id = self._remote_page(job.pagedata.elementid)
+
+        return job.cfl_id is not None
+
+    def _is_completed(self, job):
+        if self._journal and self._journal.is_completed(job.pagedata.elementid, job.page_hash):
+            logger.info(f'Skipping page qualname={job.pagedata.qualifiedName}, already '
+                        f'published by the interrupted run')
+            return True
+
+        return False
+
+    def _render(self, job):
+        if self._dedupe_images:
+            self._resolve_attachment_refs(job)
+
+        with self._tracer.span('hash'):
+            if job.attachment_refs:
+                # A reference changes with the owner page title, the page has to follow
+                refs = [list(job.attachment_refs[diagram.image]) for diagram in job.pagedata.diagrams
+                        if diagram.image in job.attachment_refs]
+                job.page_hash = utils.generate_hash(job.pagedata, refs)
+            else:
+                job.page_hash = utils.generate_hash(job.pagedata)
+
+        with self._tracer.span('render'):
+            job.body = self._renderer.render_page(pagedata=job.pagedata,
+                                                  hash=job.page_hash,
+                                                  version_info=job.version_info,
+                                                  attachment_refs=job.attachment_refs)
+
+        logger.info(f'Rendered page: qualname={job.pagedata.qualifiedName} '
+                    f'elid={job.pagedata.elementid} '
+                    f'bodylen={len(job.body)}')
 
         self._barnext()
 
-        if self._force_updates or not utils.test_hash(self._cfl.get_page_body(cfl_id), page_hash):
+    def _resolve_attachment_refs(self, job):
+        """Registers the images of the page, referencing those already owned by another page"""
+        elid = job.pagedata.elementid
+
+        for diagram in job.pagedata.diagrams:
+            digest = utils.file_digest(diagram.image)
+
+            with self._lock:
+                owner = self._image_owners.setdefault(
+                    digest, (elid, os.path.basename(diagram.image), job.pagedata.name,
+                             job.cfl_root_pageid))
+
+            owner_elid, filename, title, cfl_root_pageid = owner
+            if owner_elid != elid:
+                logger.info(f'  Referencing diagram {os.path.basename(diagram.image)} '
+                            f'attached to page {title} as {filename}')
+                job.attachment_refs[diagram.image] = (filename, title,
+                                                      self._space_key(cfl_root_pageid))
+
+    def _fetch(self, job):
+        """Retrieves the remote state of an existing page, and the diagrams to upload"""
+        if job.cfl_id is not None:
+            with self._tracer.span('fetch'):
+                body = self._cfl.get_page_body(job.cfl_id)
+                job.attachments = self._cfl.get_attachments(job.cfl_id)
+
+            job.up_to_date = self._is_up_to_date(job, body)
+
+        job.attachments_todo = self._attachments_todo(job)
+
+    def _is_up_to_date(self, job, body):
+        return not self._force_updates and utils.test_hash(body, job.page_hash)
+
+    def _estimate_cost(self, job):
+        """Estimated cost of writing a fetched page, in requests"""
+        requests = 0 if self._skip_restrictions else 1
+
+        if job.cfl_id is None:
+            requests += 1
+        else:
+            # Labels, and the page info retrieved before an update or a move
+            requests += 1
+            if not job.up_to_date:
+                requests += 2
+            if not job.is_root and job.cfl_parent_id != job.cfl_root_pageid:
+                requests += 2
+
+        upload_bytes = 0
+        for image, _ in job.attachments_todo:
+            requests += 1
+            upload_bytes += os.path.getsize(self._upload_paths.get(image, image))
+
+        return scheduler.estimate_cost(requests, upload_bytes)
+
+    def _write(self, job):
+        """Creates, moves or updates a page, then its attachments, labels and restrictions"""
+        if not self._holds_lease(job.cfl_root_pageid):
+            self._lease_lost(job)
+            return
+
+        ops = self._write_ops(job)
+
+        for op in ops:
+            method, args, kwargs = self._write_request(op, job)
             try:
-                response = self._cfl.update_page(cfl_id, pagedata.name, body)
+                response = method(*args, **kwargs)
             except APIError as e:
-                logger.info(f'Cannot update page qualname={pagedata.qualifiedName} error={e}')
-                self._errors.append((pagedata.qualifiedName, e))
+                self._write_failed(op, job, e)
                 return
 
-            logger.info(f'  Updated page content to version={response["version"]["number"]}')
-            self._summary[pagedata.qualifiedName]['updated'] = True
-        else:
-            logger.info('  Page requires no update')
+            self._written(op, job, response)
 
         self._barnext()
-        self._upload_attachments(cfl_id, pagedata)
+        with self._tracer.span('attachments', count=len(job.pagedata.diagrams)):
+            uploaded = self._upload_attachments(job)
         self._barnext()
-        self._set_labels(cfl_id, pagedata, is_root)
+        if 'create' not in ops:
+            with self._tracer.span('labels'):
+                self._cfl.set_labels(job.cfl_id, self._labels(job.pagedata, job.is_root))
         self._barnext()
 
         if not self._skip_restrictions:
-            self._cfl.set_page_restrictions(cfl_id)
+            with self._tracer.span('restrictions'):
+                self._cfl.set_page_restrictions(job.cfl_id)
             logger.info(f'  Restrictions applied')
 
-        if self._print_summary:
-            # Not sure why finish() doesn't complete the bar
-            while self._current_bar.remaining > 0:
-                self._current_bar.next()
-            self._current_bar.finish()
+        self._write_done(job, uploaded)
+
+    def _write_ops(self, job):
+        """Returns the operations publishing a page: a move, then a create or an update"""
+        logger.info(f'Processing page: qualname={job.pagedata.qualifiedName} '
+                    f'elid={job.pagedata.elementid}')
+
+        ops = []
+        if not job.is_root and job.cfl_id is not None and job.cfl_parent_id != job.cfl_root_pageid:
+            ops.append('move')
+
+        if job.cfl_id is None:
+            ops.append('create')
+        elif not job.up_to_date:
+            ops.append('update')
+        else:
+            logger.info('  Page requires no update')
+
+        return ops
+
+    def _write_request(self, op, job):
+        """Journals an operation, returns the backend (method, args, kwargs) performing it"""
+        pagedata = job.pagedata
+
+        if op == 'move':
+            logger.info(f'  Moving page id={job.cfl_id} from parent id={job.cfl_parent_id}')
+            self._journal_begin('move', job)
+            return self._cfl.move_page, (job.cfl_id, job.cfl_root_pageid), {}
+
+        if op == 'create':
+            self._journal_begin('create', job, title=pagedata.name, parent=job.cfl_root_pageid)
+            # Body, md_elid and labels are set in one go, a page without md_elid
+            # would be duplicated by the next run
+            return self._cfl.create_page, (job.cfl_root_pageid, pagedata.name, job.body), {
+                'space_key': self._space_key(job.cfl_root_pageid),
+                'properties': {ELID_PROPERTY: pagedata.elementid},
+                'labels': self._labels(pagedata, job.is_root),
+            }
 
-    def _upload_attachments(self, cfl_id, pagedata):
+        self._journal_begin('update', job)
+        return self._cfl.update_page, (job.cfl_id, pagedata.name, job.body), {}
+
+    def _written(self, op, job, response):
+        if op == 'create':
+            job.cfl_id = response['id']
+            logger.info(f'  Created new page id={job.cfl_id}')
+            self._summary[job.pagedata.qualifiedName]['updated'] = True
+        elif op == 'update':
+            logger.info(f'  Updated page content to version={response["version"]["number"]}')
+            self._summary[job.pagedata.qualifiedName]['updated'] = True
+
+    def _write_failed(self, op, job, error):
+        logger.info(f'Cannot {op} page qualname={job.pagedata.qualifiedName} error={error}')
+        self._errors.append((job.pagedata.qualifiedName, error))
+
+    def _write_done(self, job, uploaded):
+        # A page missing attachments is not completed, resuming retries the uploads
+        if self._journal and uploaded:
+            self._journal.done(job.pagedata.elementid, job.page_hash)
+
+    def _journal_begin(self, op, job, **data):
+        if self._journal:
+            self._journal.begin(op, job.pagedata.elementid, **data)
+
+    def _attachments_todo(self, job):
+        """Returns the (image, digest) of the diagrams of the page to be uploaded"""
         todo = []
-        page_attachments = self._cfl.get_attachments(cfl_id)
+        pagedata = job.pagedata
+        page_attachments = job.attachments
         for diagram in pagedata.diagrams:
+            if diagram.image in job.attachment_refs:
+                continue
+
             filename = os.path.basename(diagram.image)
+            digest = utils.file_digest(diagram.image)
+
             if self._force_updates or filename not in page_attachments:
                 logger.info(f'  Adding diagram {filename} to the todo since it is missing')
-                todo.append(diagram.image)
+                todo.append((diagram.image, digest))
+                continue
+
+            attached_digest = utils.extract_attachment_digest(page_attachments[filename]['comment'])
+
+            if attached_digest:
+                if attached_digest != digest:
+                    logger.info(f'  Adding diagram {filename} to the todo since its content changed')
+                    todo.append((diagram.image, digest))
             else:
+                # Attachments uploaded by older versions have no digest, fall back to timestamps
                 lm_attached = dateutil.parser.parse(page_attachments[filename]['last_updated'])
                 lm_available = diagram.lastModifiedDate
 
                 if diagram.type == 'table':
                     logger.info(f'  Adding diagram {filename} to the todo since it is a table')
-                    todo.append(diagram.image)
+                    todo.append((diagram.image, digest))
                 elif not isinstance(lm_available, datetime.datetime) or lm_available > lm_attached:
                     logger.info(f'  Adding diagram {filename} to the todo due to time comparison: '
                                 f'lm_available={lm_available} lm_attached={lm_attached}')
-                    todo.append(diagram.image)
+                    todo.append((diagram.image, digest))
+
+        return todo
+
+    def _upload_attachments(self, job):
+        """Returns True if all the diagrams to upload have been uploaded"""
+        files = self._upload_files(job)
+        if not files:
+            return True
+
+        results = self._cfl.upload_attachments(job.cfl_id, files, attachments=job.attachments)
+
+        return self._uploaded(job, results)
+
+    def _upload_files(self, job):
+        """Returns the (path, filename, comment) of the diagrams of the page to upload"""
+        todo = job.attachments_todo
 
         if len(todo) == 0:
             logger.info('  Diagrams require no update')
-        else:
-            logger.info(f'  Uploading attachments (count={len(todo)})')
+            return []
+
+        logger.info(f'  Uploading attachments (count={len(todo)})')
+
+        files = []
+        for attachment, digest in todo:
+            logger.info(f'    - {attachment}')
+            files.append((self._upload_paths.get(attachment, attachment),
+                          os.path.basename(attachment),
+                          utils.attachment_comment(digest)))
+
+        return files
+
+    def _uploaded(self, job, results):
+        """Records the results of the uploads, returns True if all of them succeeded"""
+        pagedata = job.pagedata
+
+        for filename, uploaded in results.items():
+            self._barnext()
+
+            if not uploaded:
+                self._errors.append((pagedata.qualifiedName, f'Cannot upload {filename}'))
 
-            for attachment in todo:
-                if self._print_summary:
-                    self._current_bar.next()
+        self._summary[pagedata.qualifiedName]['updated_attachments'] = \
+            sum(1 for uploaded in results.values() if uploaded)
 
-                logger.info(f'    - {attachment}')
-                self._cfl.upload_attachment(cfl_id, attachment)
+        return all(results.values())
 
-            self._summary[pagedata.qualifiedName]['updated_attachments'] = len(todo)
+    def _all_images(self, rootpages):
+        for rootpage in rootpages:
+            for pagedata in [rootpage.pagedata] + [subpage.pagedata for subpage in rootpage.subpages]:
+                for diagram in pagedata.diagrams:
+                    yield diagram.image
 
     def _total_steps(self, pagedata):
         return len(pagedata.diagrams) + 4
 
     def _barnext(self):
-        if self._print_summary:
+        if self._current_bar is not None:
             self._current_bar.next()
 
-    def _set_labels(self, cfl_id, subpage, is_root):
-        labels = ['_model'] + [f'_{st.lower()}' for st in subpage.stereotypes]
+    def _labels(self, pagedata, is_root):
+        labels = ['_model'] + [f'_{st.lower()}' for st in pagedata.stereotypes]
 
         if is_root:
             labels += ['_model_root']
 
         logger.info(f'  Setting labels: {labels}')
-        self._cfl.set_labels(cfl_id, labels)
 
-    def _find_page_by_elid(self, cfl_children, elid):
-        for cfl_child in cfl_children['results']:
-            prop = self._cfl.get_property(cfl_child['id'], 'md_elid')
+        return labels
+
+    def _space_key(self, cfl_pageid):
+        if cfl_pageid not in self._space_keys:
+            self._space_keys[cfl_pageid] = self._cfl.get_space_key(cfl_pageid)
+
+        return self._space_keys[cfl_pageid]
+
+    def _index_remote_pages(self):
+        """Maps md_elid -> (page id, parent id) for the children of all the root pages
+
+        Pages not created by the importer are ignored. The index spans all the root pages,
+        so that packages moved from one root page to another can be relocated in place.
+        """
+        cfl_children = self._get_children(self._report.keys())
+
+        children_ids = self._children_to_delete(cfl_children)
+        if children_ids:
+            self._delete_pages(children_ids, 'Deleting children')
+            cfl_children = self._get_children(self._report.keys())
+
+        self._index_children(cfl_children)
+
+        orphans = self._orphans_to_prune()
+        if orphans:
+            self._delete_pages(orphans, 'Pruning orphans')
+
+    def _children_to_delete(self, cfl_children):
+        if not self._delete_children:
+            return []
+
+        return [cfl_child['id'] for cfl_parent_id in self._owned
+                for cfl_child in cfl_children[cfl_parent_id]]
 
-            if prop and prop['value'] == elid:
-                return cfl_child['id']
+    def _orphans_to_prune(self):
+        orphans = self._orphans()
+        logger.info(f'Found {len(self._remote_pages)} existing pages, {len(orphans)} orphans '
+                    f'or duplicates')
 
-        return None
+        return orphans if self._prune else []
+
+    def _index_children(self, cfl_children):
+        """Adds the children of root pages to the md_elid index
+
+        All the pages carrying an md_elid are indexed: when pipelined, the root page a
+        package belongs to might not have been parsed yet.
+        """
+        with self._lock:
+            for cfl_parent_id, children in cfl_children.items():
+                self._children[cfl_parent_id] = children
+
+                for cfl_child in children:
+                    elid = self._child_elid(cfl_child)
+                    if elid is None:
+                        continue
+
+                    pages = self._remote_pages.setdefault(elid, [])
+                    if (cfl_child['id'], cfl_parent_id) not in pages:
+                        pages.append((cfl_child['id'], cfl_parent_id))
+
+    def _remote_page(self, elid):
+        """Returns the (page id, parent id) of a package, (None, None) if it has no page
+
+        When a package has more than one page, the one under the root page the package
+        belongs to is preferred, otherwise the first one found.
+        """
+        pages = self._remote_pages.get(elid)
+        if not pages:
+            return None, None
+
+        target_root = self._target_roots.get(elid)
+        for cfl_id, cfl_parent_id in pages:
+            if cfl_parent_id == target_root:
+                return cfl_id, cfl_parent_id
+
+        return pages[0]
+
+    def _orphans(self):
+        """Pages of packages not in the report anymore, and duplicates of indexed pages
+
+        Pages under root pages of other shards are left to their owners, pages under root
+        pages targeted by more than one report are left untouched: the packages of the
+        skipped report are unknown, its pages would be taken for orphans.
+        """
+        orphans = []
+        for cfl_parent_id in self._owned:
+            if cfl_parent_id in self._conflicts:
+                continue
+
+            for cfl_child in self._children.get(cfl_parent_id, []):
+                elid = self._child_elid(cfl_child)
+                if elid is None:
+                    continue
+
+                if elid not in self._target_roots or \
+                        self._remote_page(elid)[0] != cfl_child['id']:
+                    orphans.append(cfl_child['id'])
+
+        return orphans
+
+    def _child_elid(self, cfl_child):
+        prop = cfl_child.get('metadata', {}).get('properties', {}).get(ELID_PROPERTY)
+
+        return prop['value'] if prop else None
+
+    def _in_shard(self, cfl_pageid):
+        if not self._shard:
+            return True
+
+        index, count = self._shard
+        digest = hashlib.sha256(str(cfl_pageid).encode()).digest()
+
+        return int.from_bytes(digest[:8], 'big') % count == index - 1
+
+    def _acquire_lease(self, cfl_pageid):
+        """Acquires or refreshes the lease on a root page, returns False if not possible"""
+        self._lease_expires.pop(cfl_pageid, None)
+
+        lease = self._cfl.get_property(cfl_pageid, LEASE_PROPERTY)
+        if not self._lease_available(cfl_pageid, lease):
+            return False
+
+        value = self._lease_value()
+        try:
+            # Written only if unchanged since read, of concurrent writers only one succeeds
+            acquired = self._cfl.replace_property(cfl_pageid, LEASE_PROPERTY, value, lease)
+        except APIError as e:
+            logger.warning(f'Cannot lease root page id={cfl_pageid}, skipping it: {e}')
+            return False
+
+        return self._leased_until(cfl_pageid, value['expires'] if acquired else None)
+
+    def _holds_lease(self, cfl_pageid):
+        """Returns False if the lease on a root page is lost, refreshes it past half its ttl
+
+        Writing the pages of a root page may take longer than the lease ttl.
+        """
+        if not self._shard:
+            return True
+
+        with self._lease_lock:
+            if cfl_pageid not in self._lease_expires:
+                return False
+
+            return not self._lease_expiring(cfl_pageid) or self._acquire_lease(cfl_pageid)
+
+    def _lease_expiring(self, cfl_pageid):
+        return self._lease_expires[cfl_pageid] - time.time() < self._lease_ttl / 2
+
+    def _leased_until(self, cfl_pageid, expires):
+        if expires is None:
+            logger.warning(f'Root page id={cfl_pageid} has been leased by another worker, '
+                           f'skipping it')
+            return False
+
+        self._lease_expires[cfl_pageid] = expires
+        logger.info(f'Leased root page id={cfl_pageid}')
+
+        return True
+
+    def _lease_lost(self, job):
+        logger.warning(f'Skipping page qualname={job.pagedata.qualifiedName}, the lease on '
+                       f'its root page id={job.cfl_root_pageid} is lost')
+
+    def _release_leases(self):
+        if not self._shard:
+            return
+
+        for cfl_pageid in self._owned:
+            if self._owns_lease(self._cfl.get_property(cfl_pageid, LEASE_PROPERTY)):
+                self._cfl.delete_property(cfl_pageid, LEASE_PROPERTY)
+                logger.info(f'Released the lease on root page id={cfl_pageid}')
+
+    def _lease_available(self, cfl_pageid, lease):
+        """Returns False if the root page is leased by another worker and not expired"""
+        if lease:
+            owner = lease['value'].get('owner')
+            expires = lease['value'].get('expires', 0)
+
+            if owner != self._lease_owner and expires > time.time():
+                logger.warning(f'Root page id={cfl_pageid} is leased by {owner} until '
+                               f'{datetime.datetime.fromtimestamp(expires)}, skipping it')
+                return False
+
+        return True
+
+    def _lease_value(self):
+        return {
+            'owner': self._lease_owner,
+            'shard': f'{self._shard[0]}/{self._shard[1]}',
+            'expires': time.time() + self._lease_ttl,
+        }
+
+    def _owns_lease(self, lease):
+        return bool(lease) and lease['value'].get('owner') == self._lease_owner
+
+    def _get_children(self, cfl_pageids):
+        """Returns the children of each given page, properties to identify them included"""
+        cfl_pageids = list(cfl_pageids)
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            results = executor.map(lambda cfl_pageid: self._cfl.get_children(
+                cfl_pageid, expand=CHILDREN_EXPAND)['results'], cfl_pageids)
+
+            return dict(zip(cfl_pageids, results))
+
+    def _delete_pages(self, cfl_ids, title):
+        if self._show_bars:
+            bar = IncrementalBar(f'{title} ({len(cfl_ids)})',
+                                 max=len(cfl_ids),
+                                 suffix='%(percent)d%%')
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = {executor.submit(self._cfl.delete_page, cfl_id): cfl_id for cfl_id in cfl_ids}
+
+            for future in as_completed(futures):
+                self._deleted(futures[future], future.result())
+
+                if self._show_bars:
+                    bar.next()
+
+        if self._show_bars:
+            bar.finish()
+
+    def _deleted(self, cfl_id, deleted):
+        if deleted:
+            logger.info(f'  Deleted page id={cfl_id}')
+        else:
+            logger.warning(f'  Cannot delete page id={cfl_id}')
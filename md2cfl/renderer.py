@@ -33,10 +33,12 @@ class Renderer:
         # Custom filters
         self._env.filters['basename'] = lambda path: Path(path).name
 
-    def render_page(self, pagedata, version_info, hash):
+    def render_page(self, pagedata, version_info, hash, attachment_refs=None):
+        """attachment_refs maps the images attached to other pages to (filename, title, space key)"""
         template = self._env.get_template('cfl_page.html')
 
         return template.render(pagedata=pagedata,
                                version_info=version_info,
                                hash=hash,
+                               attachment_refs=attachment_refs or {},
                                now=datetime.datetime.now())
@@ -0,0 +1,111 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+
+from md2cfl import utils, report_parser
+
+logger = logging.getLogger(__name__)
+
+# Bump when the parsed model changes, invalidates the cached reports
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+class ReportCache:
+    """Stores parsed and validated reports, keyed by the digest of the report file
+
+    The key also covers the schema, the cache version and the report location, which
+    the image paths are relative to. The digests of the images are cached alongside,
+    so that the page hashes of an unchanged report are computed without reading them.
+    The least recently used entries are evicted beyond max_size bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self._cache_dir = Path(cache_dir) if cache_dir else utils.cache_dir() / 'reports'
+        self._max_size = max_size
+
+    def load(self, report_file):
+        """Returns the cached (version info, report) of a report file, None if not cached"""
+        entry = self._entry(report_file)
+
+        try:
+            with open(entry, 'rb') as f:
+                version_info, report, digests = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable cache entry {entry}: {e}')
+            return None
+
+        # Keeps track of the most recently used entries
+        os.utime(entry)
+        utils.seed_file_digests(digests)
+
+        logger.info(f'Loaded report {report_file} from the cache')
+
+        return version_info, report
+
+    def store(self, report_file, version_info, report):
+        """Caches a parsed report, failing to do so is not an error"""
+        try:
+            self._store(report_file, version_info, report)
+        except OSError as e:
+            logger.warning(f'Cannot cache report {report_file}: {e}')
+
+    def _store(self, report_file, version_info, report):
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+        images = [diagram.image for rootpage in report.values()
+                  for pagedata in [rootpage.pagedata] + [subpage.pagedata
+                                                         for subpage in rootpage.subpages]
+                  for diagram in pagedata.diagrams]
+
+        entry = self._entry(report_file)
+        tmp_entry = entry.with_suffix('.tmp')
+
+        with open(tmp_entry, 'wb') as f:
+            pickle.dump((version_info, report, utils.file_digests(images)), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_entry, entry)
+
+        logger.info(f'Stored report {report_file} in the cache')
+
+        self._evict()
+
+    def _entry(self, report_file):
+        key = hashlib.sha256(utils.file_digest(report_file).encode())
+        key.update(utils.file_digest(report_parser.SCHEMA_FILE).encode())
+        key.update(f'{CACHE_VERSION}:{Path(report_file).absolute().parent}'.encode())
+
+        return self._cache_dir / f'{key.hexdigest()}.pickle'
+
+    def _evict(self):
+        entries = sorted(self._cache_dir.glob('*.pickle'), key=lambda entry: entry.stat().st_mtime,
+                         reverse=True)
+
+        total_size = 0
+        for entry in entries:
+            total_size += entry.stat().st_size
+
+            # The most recent entry is always kept, even if exceeding the limit alone
+            if total_size > self._max_size and entry != entries[0]:
+                logger.info(f'Evicting cached report {entry.name}')
+                entry.unlink()
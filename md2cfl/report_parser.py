@@ -16,6 +16,7 @@
 
 import logging
 from pathlib import Path
+from functools import lru_cache
 import html
 
 from lxml import etree
@@ -23,6 +24,8 @@ from lxml import etree
 import dateutil.parser
 from dateutil import tz
 
+from md2cfl import utils
+
 DIAGRAM_TYPES_MAP = {
     'Generic Table': 'table',
     'SysML Block Definition Diagram': 'bdd',
@@ -37,6 +40,12 @@ DIAGRAM_TYPES_MAP = {
 
 logger = logging.getLogger(__name__)
 
+SCHEMA_FILE = Path(Path(__file__).absolute().parent, 'data/report.xsd')
+
+
+class ReportError(Exception):
+    pass
+
 
 def date_parser(text):
     try:
@@ -82,12 +91,16 @@ class BaseRep:
     def __repr__(self):
         return f'<{self.__class__.__name__} {self.__dict__}>'
 
-    def __mdrepr__(self):
-        return str(self).encode()
+    def __mdhash__(self):
+        return {attrname: utils.canonical(getattr(self, attrname, None))
+                for attrname in self.HASH_ATTRIBUTES}
 
 
 class Diagram(BaseRep):
     REPORT_BASEPATH = Path('.')
+    HASH_ATTRIBUTES = ['name', 'qualifiedName', 'type', 'documentation', 'elementUrl',
+                       'author', 'creationDate', 'lastModifiedDate', 'lastModifiedBy',
+                       'image']
     XFORMERS = {
         'lastModifiedDate': lambda node: date_parser(node.text),
         'lastModifiedBy': lambda node: node.text.strip(),
@@ -97,9 +110,6 @@ class Diagram(BaseRep):
         'documentation': cast_documentation,
     }
 
-    def __mdrepr__(self):
-        return (self.lastModifiedDate + self.image).encode()
-
 
 class PageData(BaseRep):
     HASH_ATTRIBUTES = ['stereotypes', 'name', 'qualifiedName', 'elementid',
@@ -134,16 +144,22 @@ class VersionInfo:
         return f'<{self.__class__.__name__} schema version={self.version} stepping={self.stepping}>'
 
 
+@lru_cache(maxsize=None)
+def schema():
+    """Compiled report schema, shared by all the reports parsed by the process"""
+    return etree.XMLSchema(etree.parse(str(SCHEMA_FILE)))
+
+
 def parse(report):
     Diagram.REPORT_BASEPATH = Path(report).absolute().parent
-    schema_file = str(Path(Path(__file__).absolute().parent, 'data/report.xsd'))
 
     try:
         tree = etree.parse(report)
     except etree.XMLSyntaxError as e:
         logger.error(f'The report {report} failed XML syntax validation: {e}')
+        return None, None
 
-    xsd = etree.XMLSchema(etree.parse(schema_file))
+    xsd = schema()
 
     if not xsd.validate(tree):
         logger.error(f'The report {report} failed schema validation:')
@@ -171,6 +187,40 @@ def parse(report):
     return VersionInfo(version, stepping), report
 
 
+def iterparse(report):
+    """Yields (version info, page id, root page) as soon as each root page has been parsed
+
+    The report is validated against the schema while being parsed: a ReportError is
+    raised when an invalid element is found, after the preceding root pages have
+    been yielded.
+    """
+    Diagram.REPORT_BASEPATH = Path(report).absolute().parent
+    version_info = None
+
+    try:
+        for event, node in etree.iterparse(report, events=('start', 'end'), schema=schema()):
+            if event == 'start':
+                if version_info is None:
+                    if node.tag != 'report':
+                        raise RuntimeError('Incompatible report format')
+
+                    version_info = VersionInfo(int(node.attrib['version']),
+                                               int(node.attrib['stepping']))
+            elif node.tag == 'rootpage':
+                cfl_pageid = int(node.find('pageid').text)
+                rootpage = RootPage(node)
+
+                # Root pages are converted, free the memory used by their tree
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+
+                yield version_info, cfl_pageid, rootpage
+    except etree.XMLSyntaxError as e:
+        logger.error(f'The report {report} failed validation: {e}')
+        raise ReportError(f'Invalid report {report}') from e
+
+
 if __name__ == '__main__':
     vi, rep = parse('samples/output.xml')
 
@@ -0,0 +1,84 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# Costs are expressed in requests, an upload of UPLOAD_BYTES_PER_REQUEST bytes
+# taking about as long as a request round trip
+UPLOAD_BYTES_PER_REQUEST = 512 * 1024
+# Tasks up to this cost run on the fast lane
+FAST_LANE_COST = 2
+
+
+def estimate_cost(requests, upload_bytes=0):
+    return requests + upload_bytes / UPLOAD_BYTES_PER_REQUEST
+
+
+class Task:
+    def __init__(self, cost, func, *args):
+        self.cost = cost
+        self.func = func
+        self.args = args
+
+    def __repr__(self):
+        return f'<Task {self.func.__name__} cost={self.cost:.1f}>'
+
+
+class Scheduler:
+    """Runs independent tasks on a pool of workers, the most expensive first
+
+    Starting the longest tasks first (LPT) keeps an expensive task from being picked
+    up last and defining the completion time of the whole batch. The cheapest tasks
+    run on a worker of their own, the fast lane, so that they don't wait behind the
+    expensive ones.
+    """
+    def __init__(self, workers, fast_lane_cost=FAST_LANE_COST):
+        self._workers = workers
+        self._fast_lane_cost = fast_lane_cost
+
+    def run(self, tasks, on_done=None):
+        """Runs the tasks, calling on_done after each one, and returns once all are done"""
+        heavy = sorted([task for task in tasks if task.cost > self._fast_lane_cost],
+                       key=lambda task: task.cost, reverse=True)
+        fast = [task for task in tasks if task.cost <= self._fast_lane_cost]
+
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self._workers,
+                                thread_name_prefix='scheduler') as executor, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix='fast-lane') as fast_lane:
+            # Executors pick the tasks up in submission order
+            futures = [executor.submit(task.func, *task.args) for task in heavy]
+            futures += [fast_lane.submit(task.func, *task.args) for task in fast]
+
+            for future in as_completed(futures):
+                future.result()
+
+                if on_done:
+                    on_done()
+
+        elapsed = time.monotonic() - started
+        total_cost = sum(task.cost for task in tasks)
+        # No schedule can complete before the largest task nor before the work is shared
+        lower_bound = max([total_cost / self._workers] + [task.cost for task in tasks])
+
+        logger.info(f'Scheduled tasks={len(heavy)} on workers={self._workers} and '
+                    f'tasks={len(fast)} on the fast lane: cost={total_cost:.1f} '
+                    f'lower bound={lower_bound:.1f} elapsed={elapsed:.2f}s')
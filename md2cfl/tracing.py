@@ -0,0 +1,97 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """Records timed spans and exports them in the Chrome trace-event format
+
+    The output can be loaded in chrome://tracing, https://ui.perfetto.dev or
+    any other viewer supporting the format. Spans are recorded per thread, or per
+    task within an asyncio event loop since the tasks of a loop interleave.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._origin = time.perf_counter_ns()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category='md2cfl', **args):
+        """Traces the enclosed block, the yielded args can be extended within the block"""
+        if not self.enabled:
+            yield args
+            return
+
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter_ns()
+            tid, track_name = self._track()
+
+            with self._lock:
+                self._threads[tid] = track_name
+                self._events.append({
+                    'name': name,
+                    'cat': category,
+                    'ph': 'X',
+                    'ts': (start - self._origin) / 1000,
+                    'dur': (end - start) / 1000,
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {key: str(value) for key, value in args.items()},
+                })
+
+    def _track(self):
+        """Returns the (tid, name) of the track the current span belongs to"""
+        thread = threading.current_thread()
+
+        # Without asyncio imported there cannot be any running task
+        asyncio = sys.modules.get('asyncio')
+        try:
+            task = asyncio and asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        if task:
+            return id(task), f'{thread.name} {task.get_name()}'
+
+        return thread.ident, thread.name
+
+    def save(self, filepath):
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                         'args': {'name': name}} for tid, name in self._threads.items()]
+            events = metadata + self._events
+
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        logger.info(f'Saved {len(events)} trace events to {filepath}')
+
+
+NULL_TRACER = Tracer(enabled=False)
@@ -14,31 +14,56 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import json
 import logging
 import hashlib
+import pathlib
+import platform
+import datetime
+import threading
 import re
 
 logger = logging.getLogger(__name__)
 
+DIGEST_CHUNK_SIZE = 1024 * 1024
 
-def generate_hash(pagedata):
-    hash = hashlib.sha256()
-    for attrname in pagedata.HASH_ATTRIBUTES:
-        attr = getattr(pagedata, attrname)
+# path -> (size, mtime_ns, digest), avoids hashing the same file over and over
+_digests = {}
+_digests_lock = threading.Lock()
 
-        if attr is None:
-            continue
-        elif hasattr(attr, '__mdhash__'):
-            hash.update(attr.__mdrepr__())
-        elif isinstance(attr, str):
-            hash.update(attr.encode())
-        elif isinstance(attr, list):
-            hash.update(str(attr).encode())
-        else:
-            raise RuntimeError(f'Pagedata attribute {attrname} (type={type(attr)}) '
-                               f'does not support hashing')
 
-    return hash.hexdigest()
+def canonical(value):
+    """Converts a report value into a path-independent structure suitable for hashing
+
+    Files are represented by their name and the digest of their content.
+    """
+    if hasattr(value, '__mdhash__'):
+        return value.__mdhash__()
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    elif isinstance(value, list):
+        return [canonical(item) for item in value]
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value, pathlib.PurePath):
+        try:
+            digest = file_digest(value)
+        except OSError as e:
+            logger.warning(f'Cannot compute the digest of {value}: {e}')
+            digest = None
+
+        return {'name': value.name, 'sha256': digest}
+    else:
+        raise RuntimeError(f'Value {value!r} (type={type(value)}) does not support hashing')
+
+
+def generate_hash(pagedata, *extra):
+    """Hashes the page data, along with any extra value affecting the rendered page"""
+    value = canonical([pagedata, *extra]) if extra else canonical(pagedata)
+    serialized = json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(serialized.encode()).hexdigest()
 
 
 def extract_hash(body):
@@ -52,3 +77,74 @@ def extract_hash(body):
 def test_hash(body, hash):
     hash_text = extract_hash(body)
     return hash_text == hash
+
+
+def file_digest(filepath):
+    stat = os.stat(filepath)
+    key = os.path.abspath(filepath)
+
+    with _digests_lock:
+        cached = _digests.get(key)
+
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            hash.update(chunk)
+
+    with _digests_lock:
+        _digests[key] = (stat.st_size, stat.st_mtime_ns, hash.hexdigest())
+
+    return hash.hexdigest()
+
+
+def file_digests(filepaths):
+    """Returns the memoized digests of the given files, see seed_file_digests()"""
+    digests = {}
+    for filepath in filepaths:
+        try:
+            file_digest(filepath)
+        except OSError:
+            continue
+
+        key = os.path.abspath(filepath)
+        with _digests_lock:
+            digests[key] = _digests[key]
+
+    return digests
+
+
+def seed_file_digests(digests):
+    """Restores digests previously returned by file_digests()
+
+    They are still checked against the size and modification time of the files.
+    """
+    with _digests_lock:
+        for key, cached in digests.items():
+            _digests.setdefault(key, cached)
+
+
+def attachment_comment(digest):
+    return f'$sha256={digest}'
+
+
+def extract_attachment_digest(comment):
+    match = re.search(r'\$sha256=(\w{64})', comment or '')
+    if match:
+        return match.group(1)
+    else:
+        return None
+
+
+def cache_dir():
+    system = platform.system()
+    if system in ('Darwin', 'Linux'):
+        cache_base = pathlib.Path(os.getenv('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'))
+    elif system == 'Windows':
+        cache_base = pathlib.Path(os.getenv('LOCALAPPDATA'))
+    else:
+        raise RuntimeError(f'Unknown system {system}')
+
+    return cache_base / 'md2cfl'
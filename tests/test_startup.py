@@ -0,0 +1,33 @@
+# md2cfl - MagicDraw to Confluence importer
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import subprocess
+from pathlib import Path
+
+# Heavy modules the commands import when they run, never at load time
+HEAVY_MODULES = ['requests', 'lxml', 'jinja2', 'keyring']
+
+
+def test_main_imports_no_heavy_module():
+    # A fresh interpreter, modules imported by other tests would hide a regression
+    script = ('import sys, md2cfl.__main__; '
+              f'print(" ".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))')
+
+    result = subprocess.run([sys.executable, '-c', script], cwd=Path(__file__).parents[1],
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.split() == []